@@ -26,6 +26,8 @@ import sys
 import argparse
 import time
 import shutil
+import threading
+from collections import deque
 from pathlib import Path
 import requests
 import cv2
@@ -33,6 +35,10 @@ import numpy as np
 import mediapipe as mp
 from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv
+from pipeline import Pipeline
+from tracker import FaceTracker
+from cadence import DetectionScheduler, CADENCE_TARGET_FPS
+from attendance_writer import AttendanceWriter
 
 try:
     from supabase import create_client
@@ -45,11 +51,10 @@ def ensure_dir(p: Path):
 
 
 class MediaPipeFaceRecognizer:
-    def __init__(self, known_faces_folder=None, min_detection_confidence=0.5):
+    def __init__(self, known_faces_folder=None, min_detection_confidence=0.5, target_fps=CADENCE_TARGET_FPS):
         self.mp_face_detection = mp.solutions.face_detection
-        self.face_detection = self.mp_face_detection.FaceDetection(
-            model_selection=0, min_detection_confidence=min_detection_confidence
-        )
+        self.min_detection_confidence = min_detection_confidence
+        self._local = threading.local()
 
         self.known_face_encodings = []
         self.known_face_names = []
@@ -57,9 +62,25 @@ class MediaPipeFaceRecognizer:
         if known_faces_folder:
             self._load_known_faces_from_folder(known_faces_folder)
 
-        self.prev_time = time.time()
         self.fps = 0
 
+        # Identities follow tracks across frames instead of being recomputed per frame
+        self.tracker = FaceTracker()
+        self._track_lock = threading.Lock()
+
+        # Full detection only as often as the frame-time budget allows
+        self.scheduler = DetectionScheduler(target_fps=target_fps)
+
+    @property
+    def face_detection(self):
+        # MediaPipe graphs are not thread-safe: one detector per inference thread
+        detector = getattr(self._local, 'face_detection', None)
+        if detector is None:
+            detector = self._local.face_detection = self.mp_face_detection.FaceDetection(
+                model_selection=0, min_detection_confidence=self.min_detection_confidence
+            )
+        return detector
+
     def _load_known_faces_from_folder(self, folder_path):
         print(f"Loading known faces from {folder_path}...")
         if not os.path.exists(folder_path):
@@ -117,10 +138,50 @@ class MediaPipeFaceRecognizer:
             print(f"Error extracting encoding: {e}")
             return None
 
+    def _encode_box(self, gray, box):
+        # Same 200x200 grayscale encoding as _extract_single_encoding, from a box
+        # the frame's detection already found (no second detector pass on the crop)
+        x, y, width, height = box
+        face = gray[y:y+height, x:x+width]
+        if face.size == 0:
+            return None
+        return (cv2.resize(face, (200, 200)).astype(np.float32) / 255.0).flatten()
+
+    def _identify(self, enc, threshold):
+        name = 'Unknown'
+        conf = 0.0
+        if self.known_face_encodings:
+            if enc is not None:
+                sims = []
+                for i, known in enumerate(self.known_face_encodings):
+                    min_len = min(len(enc), len(known))
+                    if min_len == 0:
+                        continue
+                    sim = cosine_similarity(enc[:min_len].reshape(1, -1), known[:min_len].reshape(1, -1))[0][0]
+                    sims.append((sim, self.known_face_names[i]))
+                if sims:
+                    best_sim, best_name = max(sims, key=lambda x: x[0])
+                    if best_sim >= threshold:
+                        name = best_name
+                        conf = float(best_sim)
+        return name, conf
+
     def recognize(self, frame, threshold=0.6):
+        started = time.perf_counter()
+        if not self.scheduler.should_detect(frame):
+            # Between detections the tracker carries the previous boxes forward
+            with self._track_lock:
+                detections = [
+                    (*track.int_box, track.name or 'Unknown', track.confidence)
+                    for track in self.tracker.propagate()
+                ]
+            self.scheduler.record(False, time.perf_counter() - started)
+            self.fps = self.scheduler.fps
+            return detections
+
         rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         results = self.face_detection.process(rgb)
-        detections = []
+        boxes = []
         if results.detections:
             for det in results.detections:
                 bbox = det.location_data.relative_bounding_box
@@ -132,29 +193,33 @@ class MediaPipeFaceRecognizer:
                 face = frame[y:y+height, x:x+width]
                 if face.size == 0:
                     continue
-                name = 'Unknown'
-                conf = 0.0
-                if self.known_face_encodings:
-                    enc = self._extract_single_encoding(face)
-                    if enc is not None:
-                        sims = []
-                        for i, known in enumerate(self.known_face_encodings):
-                            min_len = min(len(enc), len(known))
-                            if min_len == 0:
-                                continue
-                            sim = cosine_similarity(enc[:min_len].reshape(1, -1), known[:min_len].reshape(1, -1))[0][0]
-                            sims.append((sim, self.known_face_names[i]))
-                        if sims:
-                            best_sim, best_name = max(sims, key=lambda x: x[0])
-                            if best_sim >= threshold:
-                                name = best_name
-                                conf = float(best_sim)
-                detections.append((x, y, width, height, name, conf))
-
-        # update fps
-        now = time.time()
-        self.fps = 1.0 / (now - self.prev_time) if now != self.prev_time else 0
-        self.prev_time = now
+                boxes.append((x, y, width, height))
+
+        # Only new tracks, and tracks due for re-verification, are recognized.
+        # Inference threads can finish a frame or two out of order; neighbouring
+        # frames overlap enough that association is unaffected.
+        with self._track_lock:
+            tracks = self.tracker.update(boxes)
+            pending = [track for track in tracks if self.tracker.needs_identity(track)]
+            for track in pending:
+                self.tracker.begin_identity(track)
+        if any(track.hits == 1 for track in tracks):
+            self.scheduler.faces_changed()
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if pending else None
+        for box, track in zip(boxes, tracks):
+            if track in pending:
+                name, conf = self._identify(self._encode_box(gray, box), threshold)
+                with self._track_lock:
+                    self.tracker.set_identity(track, name, conf)
+
+        detections = [
+            (x, y, width, height, track.name or 'Unknown', track.confidence)
+            for (x, y, width, height), track in zip(boxes, tracks)
+        ]
+
+        self.scheduler.record(True, time.perf_counter() - started)
+        self.fps = self.scheduler.fps
         return detections
 
 
@@ -215,23 +280,6 @@ def draw_detections(frame, detections):
     return frame
 
 
-def insert_attendance(supabase, session_id, recognized_identifier, user_id, confidence):
-    try:
-        payload = {
-            'session_id': session_id,
-            'student_user_id': user_id,
-            'student_identifier': recognized_identifier,
-            'confidence': float(confidence)
-        }
-        res = supabase.table('attendance_logs').insert(payload).execute()
-        if res.status_code in (200, 201):
-            return True
-        print('Insert attendance failed:', res.status_code, res.text)
-    except Exception as e:
-        print('Error inserting attendance:', e)
-    return False
-
-
 def list_cameras(max_tests=5):
     # Try to detect available camera indices by attempting to open them briefly
     available = []
@@ -272,6 +320,10 @@ def main():
     parser.add_argument('--threshold', type=float, default=0.6, help='Cosine similarity threshold')
     parser.add_argument('--camera-index', type=int, help='Preferred camera index to use')
     parser.add_argument('--list-cameras', action='store_true', help='List available camera indices and exit')
+    parser.add_argument('--target-fps', type=float, default=CADENCE_TARGET_FPS,
+                        help='Frame rate to hold; full detection is spaced out to stay within it')
+    parser.add_argument('--workers', type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)),
+                        help='Inference threads (each runs its own detector)')
     args = parser.parse_args()
 
     load_dotenv()
@@ -298,7 +350,8 @@ def main():
     downloaded = download_student_images(supabase, args.bucket, workdir)
 
     # Build recognizer
-    recognizer = MediaPipeFaceRecognizer(str(workdir))
+    # Each inference thread gets its share of the frame budget
+    recognizer = MediaPipeFaceRecognizer(str(workdir), target_fps=args.target_fps / max(1, args.workers))
 
     # Start webcam
     if args.list_cameras:
@@ -319,52 +372,59 @@ def main():
 
     print('Starting recognition. Press q to quit.')
 
-    seen = set()
+    # Capture and inference run in the background; this thread renders
+    pipeline = Pipeline(
+        cap, lambda image: recognizer.recognize(image, threshold=args.threshold), workers=args.workers
+    ).start()
+    shown = deque(maxlen=30)
+
+    # Attendance is written in the background, never on the frame path
+    writer = AttendanceWriter(supabase, args.session_id)
 
     while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+        result = pipeline.next_result(timeout=0.05)
+        if result is None:
+            if not pipeline.running:
+                break
+            # Keep the window responsive while inference catches up
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+            continue
 
-        detections = recognizer.recognize(frame, threshold=args.threshold)
-        frame = draw_detections(frame, detections)
+        render_started = time.perf_counter()
+        detections = result.detections
+        frame = draw_detections(result.image, detections)
 
-        # For each recognized face, attempt to insert attendance
+        # For each recognized face, queue attendance (the writer dedupes per session)
         for (x, y, w, h, name, conf) in detections:
             if name != 'Unknown' and conf > args.threshold:
-                # name is the identifier folder name we created earlier
-                # We try to map back to user_id by querying student table
-                # To avoid duplicates, key on (session_id, name)
-                key = (args.session_id, name)
-                if key in seen:
-                    continue
-                # Try to find a user_id for this identifier
-                user_id = None
-                try:
-                    # lookup student by student_number or user_id
-                    r = supabase.table('student').select('user_id').eq('student_number', name).execute()
-                    if r.status_code in (200, 201) and r.data:
-                        user_id = r.data[0].get('user_id')
-                except Exception:
-                    pass
-
-                # fallback: assume name is user_id
-                if not user_id:
-                    user_id = name
-
-                success = insert_attendance(supabase, args.session_id, name, user_id, conf)
-                if success:
-                    print(f"Marked attendance for {name} (user {user_id}) conf={conf:.2f}")
-                    seen.add(key)
-
-        # Show FPS and counts
-        cv2.putText(frame, f"FPS: {recognizer.fps:.1f}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+                # name is the identifier folder name we created earlier;
+                # the writer maps it back to a user_id
+                writer.submit(name, conf)
+
+        # Show FPS (frames actually displayed) and end-to-end latency
+        shown.append(time.perf_counter())
+        fps = (len(shown) - 1) / (shown[-1] - shown[0]) if len(shown) > 1 and shown[-1] > shown[0] else 0.0
+        latency = pipeline.timers['end_to_end'].summary()
+        cv2.putText(frame, f"FPS: {fps:.1f}  latency: {latency['mean_ms']:.0f} ms", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
         cv2.imshow('Attendance Recognizer', frame)
+        pipeline.frame_shown(result, render_started)
 
         k = cv2.waitKey(1) & 0xFF
         if k == ord('q'):
             break
 
+    pipeline.stop()
+    writer.close()
+    if pipeline.camera_failed:
+        print('Camera stopped delivering frames')
+    for stage, stat in pipeline.stats().items():
+        print(f'{stage}: {stat}')
+    print(f'tracking: {recognizer.tracker.stats()}')
+    print(f'cadence: {recognizer.scheduler.stats()}')
+    print(f'attendance: {writer.stats()}')
+
     cap.release()
     cv2.destroyAllWindows()
 
@@ -0,0 +1,290 @@
+"""
+attendance_writer.py
+
+Background writer for attendance_recognizer.py. The capture loop only calls
+submit(); a worker thread deduplicates events, resolves user ids for a whole
+batch with one query, bulk-inserts into `attendance_logs`, and retries with
+exponential backoff when the network or Supabase fails. A batch rejected for
+its data (4xx, constraint violations) is split until the bad rows are found;
+those go to a dead-letter file so they cannot hold up the rest.
+
+Events not yet confirmed are kept in a JSONL journal next to the script, so
+they survive a stall, a crash or quitting early and are sent on the next run.
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import threading
+from pathlib import Path
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+# Rows per insert, and how long to wait for more events before sending a partial batch
+ATTENDANCE_BATCH_SIZE = int(os.getenv('ATTENDANCE_BATCH_SIZE', '50'))
+ATTENDANCE_FLUSH_SECONDS = float(os.getenv('ATTENDANCE_FLUSH_SECONDS', '1.0'))
+
+# Retry backoff bounds (seconds)
+ATTENDANCE_RETRY_MIN = float(os.getenv('ATTENDANCE_RETRY_MIN', '1'))
+ATTENDANCE_RETRY_MAX = float(os.getenv('ATTENDANCE_RETRY_MAX', '60'))
+
+# Unsent events, and events the database refused, next to this script by default
+_HERE = os.path.dirname(os.path.abspath(__file__))
+ATTENDANCE_JOURNAL = os.getenv('ATTENDANCE_JOURNAL', os.path.join(_HERE, 'attendance_journal.jsonl'))
+ATTENDANCE_DEAD_LETTER = os.getenv('ATTENDANCE_DEAD_LETTER', os.path.join(_HERE, 'attendance_dead_letter.jsonl'))
+
+# Postgres error classes that are about the connection or server, not the row
+_TRANSIENT_SQLSTATE = ('08', '40', '53', '57', '58')
+
+
+class WriteError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status_code = status
+
+
+def _ok(res):
+    # Older clients report a status code, newer ones raise on errors
+    status = getattr(res, 'status_code', None)
+    return status is None or status in (200, 201)
+
+
+def _is_transient(error):
+    """Network trouble, timeouts and 5xx are worth retrying; other errors are the data's fault"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if isinstance(status, int):
+        return status >= 500 or status in (408, 429)
+    code = getattr(error, 'code', None)
+    if isinstance(code, str) and code:
+        # PostgREST APIError: SQLSTATE (e.g. 23505) or PGRST code
+        return code.startswith(_TRANSIENT_SQLSTATE)
+    # Unknown failure: keep the events and retry rather than drop them
+    return True
+
+
+class AttendanceWriter:
+    def __init__(self, supabase, session_id, journal_path=ATTENDANCE_JOURNAL,
+                 batch_size=ATTENDANCE_BATCH_SIZE, flush_seconds=ATTENDANCE_FLUSH_SECONDS,
+                 dead_letter_path=ATTENDANCE_DEAD_LETTER):
+        self.supabase = supabase
+        self.session_id = session_id
+        self.journal_path = Path(journal_path)
+        self.dead_letter_path = Path(dead_letter_path)
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._seen = set()
+        self._pending = []
+        self._user_ids = {}
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+        self.sent = 0
+        self.failures = 0
+        self.rejected = 0
+
+        # Unsent events from an earlier run go out first
+        for event in self._read_journal():
+            self._seen.add((event['session_id'], event['student_identifier']))
+            self._pending.append(event)
+        if self._pending:
+            print(f'Resending {len(self._pending)} journaled attendance events')
+
+        self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, identifier, confidence):
+        """Queue one recognition; repeats for the same student and session are ignored"""
+        key = (self.session_id, identifier)
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        self._queue.put({
+            'session_id': self.session_id,
+            'student_identifier': identifier,
+            'confidence': float(confidence),
+            'recognized_at': time.time(),
+        })
+        return True
+
+    def close(self, timeout=5.0):
+        """Try to send what is left within timeout; anything unsent stays in the journal"""
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print('Attendance writer still busy; unsent events are kept in', self.journal_path)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'pending': len(self._pending) + self._queue.qsize(),
+            'failures': self.failures,
+            'rejected': self.rejected,
+        }
+
+    # Journal
+
+    def _read_journal(self):
+        events = []
+        if not self.journal_path.exists():
+            return events
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Torn last line from a crash mid-write
+                    continue
+        return events
+
+    def _append_journal(self, events):
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self):
+        # Only unsent events are kept; replace atomically
+        if not self._pending:
+            self.journal_path.unlink(missing_ok=True)
+            return
+        tmp = self.journal_path.with_suffix(self.journal_path.suffix + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for event in self._pending:
+                f.write(json.dumps(event) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+
+    def _dead_letter(self, event, error):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(event, error=str(error))) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.rejected += 1
+        print(f"Attendance for {event['student_identifier']} rejected ({error}); kept in {self.dead_letter_path}")
+
+    # Worker
+
+    def _drain(self, wait):
+        """Move queued events to pending (and the journal), waiting up to `wait` for the first"""
+        events = []
+        try:
+            events.append(self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait())
+            while len(events) < self.batch_size:
+                events.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if events:
+            self._append_journal(events)
+            self._pending.extend(events)
+
+    def _resolve_user_ids(self, identifiers):
+        """
+        Map student numbers to user ids with one query. Unknown ones, and all
+        of them when the lookup fails, fall back to the identifier: the lookup
+        never holds up or rejects the attendance insert.
+        """
+        missing = [i for i in identifiers if i not in self._user_ids]
+        if missing:
+            try:
+                res = self.supabase.table('student').select('user_id,student_number').in_('student_number', missing).execute()
+                if not _ok(res):
+                    raise WriteError(f'{res.status_code} {res.text}', res.status_code)
+            except Exception as e:
+                # Not cached, so the next batch asks again
+                print(f'Student lookup failed ({e}); using identifiers as user ids')
+                return {i: self._user_ids.get(i) or i for i in identifiers}
+            for row in res.data or []:
+                self._user_ids[row.get('student_number')] = row.get('user_id')
+            for identifier in missing:
+                self._user_ids.setdefault(identifier, None)
+        return {i: self._user_ids.get(i) or i for i in identifiers}
+
+    def _send(self, batch):
+        user_ids = self._resolve_user_ids(sorted({e['student_identifier'] for e in batch}))
+        rows = [{
+            'session_id': e['session_id'],
+            'student_user_id': user_ids[e['student_identifier']],
+            'student_identifier': e['student_identifier'],
+            'confidence': e['confidence'],
+        } for e in batch]
+        res = self.supabase.table('attendance_logs').insert(rows).execute()
+        if not _ok(res):
+            raise WriteError(f'insert failed: {res.status_code} {res.text}', res.status_code)
+        for e in batch:
+            print(f"Marked attendance for {e['student_identifier']} "
+                  f"(user {user_ids[e['student_identifier']]}) conf={e['confidence']:.2f}")
+
+    def _settle(self, batch):
+        # Sent or dead-lettered: drop from pending and the journal
+        done = {id(e) for e in batch}
+        self._pending = [e for e in self._pending if id(e) not in done]
+        self._rewrite_journal()
+
+    def _deliver(self, batch):
+        """
+        Send a batch. When the database refuses it for its data, split it
+        to isolate the bad rows. Transient errors propagate to be retried;
+        the parts already settled are not sent again.
+        """
+        try:
+            self._send(batch)
+        except Exception as e:
+            if _is_transient(e):
+                raise
+            if len(batch) == 1:
+                self._dead_letter(batch[0], e)
+                self._settle(batch)
+                return
+            middle = len(batch) // 2
+            self._deliver(batch[:middle])
+            self._deliver(batch[middle:])
+            return
+        self.sent += len(batch)
+        self._settle(batch)
+
+    def _flush(self):
+        try:
+            self._deliver(self._pending[:self.batch_size])
+        except Exception as e:
+            self.failures += 1
+            self._backoff = min(ATTENDANCE_RETRY_MAX, max(ATTENDANCE_RETRY_MIN, self._backoff * 2))
+            self._retry_at = time.monotonic() + self._backoff * random.uniform(0.5, 1.0)
+            print(f'Attendance write failed ({e}); retrying in {self._backoff:.0f}s')
+            return False
+
+        self._backoff = 0.0
+        return True
+
+    def _run(self):
+        while True:
+            stopping = self._stop.is_set()
+            # Blocks up to flush_seconds, which also paces retries while backing off
+            full = len(self._pending) >= self.batch_size and time.monotonic() >= self._retry_at
+            self._drain(0 if stopping or full else self.flush_seconds)
+
+            if self._pending and time.monotonic() >= self._retry_at:
+                if not self._flush() and stopping:
+                    return
+            elif stopping and self._queue.empty():
+                # Nothing more can go out now; unsent events stay in the journal
+                return
@@ -0,0 +1,133 @@
+"""
+cadence.py
+
+Decides, frame by frame, whether to run full face detection or to let the
+tracker carry the previous boxes forward. Detection runs as often as the
+frame-time budget allows: the scheduler keeps a rolling cost of both kinds
+of frame and picks the detection interval whose average cost fits
+1 / CADENCE_TARGET_FPS. Motion in the image, or new faces showing up,
+bring detection back to every frame for a while.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+# Frame rate to hold; detection is spaced out until the average frame fits
+CADENCE_TARGET_FPS = float(os.getenv("CADENCE_TARGET_FPS", "15"))
+
+# Never go longer than this many frames without detecting
+CADENCE_MAX_INTERVAL = int(os.getenv("CADENCE_MAX_INTERVAL", "8"))
+
+# Mean grey-level change (0-255) on a small thumbnail that counts as motion
+CADENCE_MOTION_THRESHOLD = float(os.getenv("CADENCE_MOTION_THRESHOLD", "6"))
+
+# Frames to detect on every frame after motion or a new face
+CADENCE_BOOST_FRAMES = int(os.getenv("CADENCE_BOOST_FRAMES", "10"))
+
+_THUMBNAIL = (64, 48)
+
+
+class DetectionScheduler:
+    """
+    Thread-safe. Call should_detect(frame) before processing a frame and
+    record(detected, seconds) after it; faces_changed() when a detection
+    starts new tracks.
+    """
+
+    def __init__(self, target_fps=CADENCE_TARGET_FPS, max_interval=CADENCE_MAX_INTERVAL,
+                 motion_threshold=CADENCE_MOTION_THRESHOLD, boost_frames=CADENCE_BOOST_FRAMES):
+        self.budget = 1.0 / target_fps if target_fps > 0 else 0.0
+        self.max_interval = max(1, max_interval)
+        self.motion_threshold = motion_threshold
+        self.boost_frames = boost_frames
+
+        self.interval = 1
+        self._since_detect = 0
+        self._boost = 0
+        self._reference = None
+        self._lock = threading.Lock()
+
+        # Rolling per-kind cost (EWMA, seconds) and frame timestamps for FPS
+        self.detect_cost = None
+        self.propagate_cost = None
+        self._times = deque(maxlen=30)
+
+        self.detections = 0
+        self.propagations = 0
+
+    def _motion(self, frame):
+        thumbnail = cv2.resize(frame, _THUMBNAIL, interpolation=cv2.INTER_AREA)
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        thumbnail = thumbnail.astype(np.int16)
+        if self._reference is None:
+            return float("inf"), thumbnail
+        return float(np.mean(np.abs(thumbnail - self._reference))), thumbnail
+
+    def should_detect(self, frame):
+        with self._lock:
+            motion, thumbnail = self._motion(frame)
+            if motion >= self.motion_threshold:
+                self._boost = self.boost_frames
+
+            detect = self._boost > 0 or self._since_detect + 1 >= self.interval
+            if detect:
+                self._since_detect = 0
+                self._boost = max(0, self._boost - 1)
+                # Motion is measured against the last detected frame
+                self._reference = thumbnail
+            else:
+                self._since_detect += 1
+            return detect
+
+    def faces_changed(self):
+        with self._lock:
+            self._boost = self.boost_frames
+
+    def record(self, detected, seconds):
+        """Feed back how long the frame took and re-plan the interval"""
+        with self._lock:
+            self._times.append(time.perf_counter())
+            if detected:
+                self.detections += 1
+                self.detect_cost = seconds if self.detect_cost is None else 0.8 * self.detect_cost + 0.2 * seconds
+            else:
+                self.propagations += 1
+                self.propagate_cost = seconds if self.propagate_cost is None else 0.8 * self.propagate_cost + 0.2 * seconds
+            self._plan()
+
+    def _plan(self):
+        if not self.budget or self.detect_cost is None or self.detect_cost <= self.budget:
+            self.interval = 1
+            return
+        # Smallest k with (detect + (k - 1) * propagate) / k <= budget
+        light = self.propagate_cost or 0.0
+        if light >= self.budget:
+            self.interval = self.max_interval
+            return
+        k = int(np.ceil((self.detect_cost - light) / (self.budget - light)))
+        self.interval = int(min(self.max_interval, max(1, k)))
+
+    @property
+    def fps(self):
+        """Frames per second over the last few frames"""
+        with self._lock:
+            if len(self._times) < 2 or self._times[-1] <= self._times[0]:
+                return 0.0
+            return (len(self._times) - 1) / (self._times[-1] - self._times[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "detections": self.detections,
+                "propagations": self.propagations,
+                "detect_ms": (self.detect_cost or 0.0) * 1000.0,
+                "propagate_ms": (self.propagate_cost or 0.0) * 1000.0,
+            }
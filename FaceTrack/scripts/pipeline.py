@@ -0,0 +1,186 @@
+"""
+pipeline.py
+
+Capture / inference / render stages for attendance_recognizer.py, joined by
+small drop-oldest queues so a slow stage skips frames instead of letting
+them go stale:
+
+  capture thread  -> keeps only the freshest camera frame
+  inference pool  -> N threads, each running the recognizer on its own detector
+  render (caller) -> pulls finished frames in capture order, draws and shows
+
+Every stage records its latency so the window can show where time goes.
+"""
+
+import time
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class DropOldestQueue:
+    """Bounded queue whose put() never blocks: the oldest item makes room instead"""
+
+    def __init__(self, maxsize=1):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._lock:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def get(self, timeout=None):
+        """Next item, or None after timeout"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class StageTimer:
+    """Rolling latency of one stage (seconds in, milliseconds out)"""
+
+    def __init__(self, window=120):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def summary(self):
+        with self._lock:
+            samples = np.array(self._samples) * 1000.0
+        if samples.size == 0:
+            return {"count": self.count, "mean_ms": 0.0, "p95_ms": 0.0}
+        return {
+            "count": self.count,
+            "mean_ms": float(samples.mean()),
+            "p95_ms": float(np.percentile(samples, 95)),
+        }
+
+
+class Frame:
+    """A captured frame travelling through the stages"""
+
+    __slots__ = ("seq", "image", "captured_at", "detections")
+
+    def __init__(self, seq, image, captured_at):
+        self.seq = seq
+        self.image = image
+        self.captured_at = captured_at
+        self.detections = []
+
+
+class Pipeline:
+    """
+    Runs capture and inference in background threads. infer(image) is
+    called concurrently from `workers` threads and must be thread-safe.
+    Call next_result() from the display thread.
+    """
+
+    def __init__(self, cap, infer, workers=2, result_buffer=2):
+        self.cap = cap
+        self.infer = infer
+        self.workers = max(1, workers)
+
+        self._frames = DropOldestQueue(maxsize=1)
+        self._results = DropOldestQueue(maxsize=max(1, result_buffer))
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_seq = -1
+
+        self.timers = {
+            "capture": StageTimer(),
+            "inference": StageTimer(),
+            "render": StageTimer(),
+            "end_to_end": StageTimer(),
+        }
+        self.camera_failed = False
+        self.errors = 0
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._capture_loop, name="capture", daemon=True)]
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._inference_loop, name=f"inference-{i}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    @property
+    def running(self):
+        return not self._stop.is_set()
+
+    def _capture_loop(self):
+        seq = 0
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            ret, image = self.cap.read()
+            if not ret:
+                self.camera_failed = True
+                self._stop.set()
+                return
+            self.timers["capture"].record(time.perf_counter() - start)
+            self._frames.put(Frame(seq, image, time.perf_counter()))
+            seq += 1
+
+    def _inference_loop(self):
+        while not self._stop.is_set():
+            frame = self._frames.get(timeout=0.1)
+            if frame is None:
+                continue
+            start = time.perf_counter()
+            try:
+                frame.detections = self.infer(frame.image)
+            except Exception as e:
+                self.errors += 1
+                print(f"Inference error: {e}")
+                continue
+            self.timers["inference"].record(time.perf_counter() - start)
+            self._results.put(frame)
+
+    def next_result(self, timeout=0.1):
+        """
+        Next finished frame, or None. Workers can finish out of order, so
+        frames older than the last one returned are skipped.
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            frame = self._results.get(timeout=max(0.0, deadline - time.perf_counter()))
+            if frame is None:
+                return None
+            if frame.seq > self._last_seq:
+                self._last_seq = frame.seq
+                return frame
+            self._results.dropped += 1
+
+    def frame_shown(self, frame, render_started):
+        """Record render and end-to-end latency once a frame is on screen"""
+        now = time.perf_counter()
+        self.timers["render"].record(now - render_started)
+        self.timers["end_to_end"].record(now - frame.captured_at)
+
+    def stats(self):
+        stats = {name: timer.summary() for name, timer in self.timers.items()}
+        stats["dropped"] = {"capture": self._frames.dropped, "results": self._results.dropped}
+        stats["errors"] = self.errors
+        return stats
@@ -0,0 +1,191 @@
+"""
+tracker.py
+
+Lightweight cross-frame face tracker. Detections are associated with
+existing tracks by IoU (falling back to centroid distance for fast moves),
+so each face keeps a stable track id and its identity only has to be
+computed when the track is born, then re-verified every
+TRACK_REVERIFY_FRAMES frames or when its confidence is low.
+"""
+
+import os
+import itertools
+import numpy as np
+
+
+# Minimum IoU to continue a track, and frames a track survives without a detection
+TRACK_IOU = float(os.getenv("TRACK_IOU", "0.3"))
+TRACK_MAX_MISSES = int(os.getenv("TRACK_MAX_MISSES", "10"))
+
+# Re-run recognition for a track every N frames, or sooner while below this confidence
+TRACK_REVERIFY_FRAMES = int(os.getenv("TRACK_REVERIFY_FRAMES", "30"))
+TRACK_REVERIFY_BELOW = float(os.getenv("TRACK_REVERIFY_BELOW", "0.0"))
+
+# Unknown faces are retried sooner than recognized ones
+TRACK_RETRY_UNKNOWN_FRAMES = int(os.getenv("TRACK_RETRY_UNKNOWN_FRAMES", "5"))
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Pairwise IoU of two (n, 4) arrays of (x, y, w, h) boxes"""
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+
+    inter_w = np.clip(np.minimum(ax2[:, None], bx2[None, :]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    inter_h = np.clip(np.minimum(ay2[:, None], by2[None, :]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    inter = inter_w * inter_h
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+class Track:
+    __slots__ = ("id", "box", "velocity", "name", "confidence", "hits", "misses", "verified_at", "born_at")
+
+    def __init__(self, track_id, box, frame_index):
+        self.id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.velocity = np.zeros(2, dtype=np.float32)
+        self.name = None
+        self.confidence = 0.0
+        self.hits = 1
+        self.misses = 0
+        self.verified_at = None
+        self.born_at = frame_index
+
+    @property
+    def int_box(self):
+        return tuple(int(round(v)) for v in self.box)
+
+    def predicted_box(self, steps=1):
+        """Box moved along the recent centre velocity"""
+        box = self.box.copy()
+        box[:2] += self.velocity * steps
+        return box
+
+
+class FaceTracker:
+    """
+    Greedy IoU tracker. Call update() once per detector run with that
+    frame's boxes; it returns the track for every box, in order.
+    """
+
+    def __init__(self, iou_threshold=TRACK_IOU, max_misses=TRACK_MAX_MISSES,
+                 reverify_frames=TRACK_REVERIFY_FRAMES, reverify_below=TRACK_REVERIFY_BELOW,
+                 retry_unknown_frames=TRACK_RETRY_UNKNOWN_FRAMES):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.reverify_frames = reverify_frames
+        self.reverify_below = reverify_below
+        self.retry_unknown_frames = retry_unknown_frames
+        self.tracks = []
+        self.frame_index = 0
+        self._ids = itertools.count(1)
+
+        # Work saved: identities computed vs. faces seen
+        self.recognitions = 0
+        self.observations = 0
+
+    def _associate(self, boxes):
+        """(box index, track index) pairs, best IoU first, then nearest centre"""
+        if not self.tracks or len(boxes) == 0:
+            return []
+        predicted = np.stack([track.predicted_box() for track in self.tracks])
+        overlap = iou_matrix(boxes, predicted)
+
+        pairs = []
+        used_boxes, used_tracks = set(), set()
+        for flat in np.argsort(-overlap, axis=None):
+            i, j = np.unravel_index(flat, overlap.shape)
+            if overlap[i, j] < self.iou_threshold:
+                break
+            if i in used_boxes or j in used_tracks:
+                continue
+            pairs.append((int(i), int(j)))
+            used_boxes.add(i)
+            used_tracks.add(j)
+
+        # Fast moves: no overlap left, but the centre is within half a face
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        for i in range(len(boxes)):
+            if i in used_boxes:
+                continue
+            centre = boxes[i, :2] + boxes[i, 2:] / 2
+            best, best_distance = None, None
+            for j, box in enumerate(predicted):
+                if j in used_tracks:
+                    continue
+                distance = np.linalg.norm(centre - (box[:2] + box[2:] / 2))
+                if distance < 0.5 * max(box[2], box[3]) and (best is None or distance < best_distance):
+                    best, best_distance = j, distance
+            if best is not None:
+                pairs.append((i, best))
+                used_boxes.add(i)
+                used_tracks.add(best)
+        return pairs
+
+    def update(self, boxes):
+        """Advance one frame with the detector's (x, y, w, h) boxes; returns their tracks"""
+        self.frame_index += 1
+        self.observations += len(boxes)
+        assigned = [None] * len(boxes)
+        matched_tracks = set()
+
+        for i, j in self._associate(boxes):
+            track = self.tracks[j]
+            box = np.asarray(boxes[i], dtype=np.float32)
+            centre_shift = (box[:2] + box[2:] / 2) - (track.box[:2] + track.box[2:] / 2)
+            track.velocity = 0.5 * track.velocity + 0.5 * centre_shift
+            track.box = box
+            track.hits += 1
+            track.misses = 0
+            assigned[i] = track
+            matched_tracks.add(j)
+
+        for j, track in enumerate(self.tracks):
+            if j not in matched_tracks:
+                track.misses += 1
+
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for i, box in enumerate(boxes):
+            if assigned[i] is None:
+                track = Track(next(self._ids), box, self.frame_index)
+                self.tracks.append(track)
+                assigned[i] = track
+        return assigned
+
+    def propagate(self):
+        """
+        Advance one frame without running the detector: tracks coast along
+        their velocity. Returns the live tracks.
+        """
+        self.frame_index += 1
+        for track in self.tracks:
+            track.box = track.predicted_box()
+        return [track for track in self.tracks if track.misses == 0]
+
+    def needs_identity(self, track):
+        if track.verified_at is None:
+            return True
+        age = self.frame_index - track.verified_at
+        if track.name in (None, "Unknown"):
+            return age >= self.retry_unknown_frames
+        return age >= self.reverify_frames or track.confidence < self.reverify_below
+
+    def begin_identity(self, track):
+        """Mark a track as being recognized, so concurrent callers skip it"""
+        track.verified_at = self.frame_index
+
+    def set_identity(self, track, name, confidence):
+        track.name = name
+        track.confidence = float(confidence)
+        track.verified_at = self.frame_index
+        self.recognitions += 1
+
+    def stats(self):
+        return {
+            "tracks": len(self.tracks),
+            "observations": self.observations,
+            "recognitions": self.recognitions,
+        }
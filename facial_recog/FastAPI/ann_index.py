@@ -0,0 +1,145 @@
+import os
+import time
+import numpy as np
+from log import get_logger
+
+
+log = get_logger("ann_index")
+
+# Index settings (ANN_PROBES / ANN_RERANK are the recall vs latency knobs)
+ANN_ENABLED = os.getenv("ANN_ENABLED", "0") == "1"
+ANN_DIM = int(os.getenv("ANN_DIM", "256"))
+ANN_LISTS = int(os.getenv("ANN_LISTS", "0"))  # 0 = about sqrt(gallery size)
+ANN_PROBES = int(os.getenv("ANN_PROBES", "8"))
+ANN_RERANK = int(os.getenv("ANN_RERANK", "64"))
+
+# Rebuild once rows appended since the build pass this fraction of the indexed rows
+ANN_TAIL_RATIO = float(os.getenv("ANN_TAIL_RATIO", "0.1"))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class IVFIndex:
+    """
+    Inverted-file index over the whole gallery for campus-wide lookups.
+
+    Rows are sketched into a small random projection, clustered with
+    spherical k-means, and stored contiguously per cluster. A search
+    scores the probe against the closest `n_probe` clusters in sketch
+    space, then re-ranks the best `rerank` candidates with exact cosine
+    similarity on the full gallery rows.
+    """
+
+    def __init__(self, dim=ANN_DIM, n_lists=ANN_LISTS, iterations=10, seed=0, tail_ratio=ANN_TAIL_RATIO):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.tail_ratio = tail_ratio
+        self.iterations = iterations
+        self.seed = seed
+
+        self.gallery = None
+        self.generation = -1
+        self.size = 0
+
+    def is_stale(self, gallery):
+        """
+        True when the gallery was replaced or compacted since the last
+        build, or when too many rows were appended after it (those are
+        scanned exactly on every search)
+        """
+        if gallery is not self.gallery or gallery.generation != self.generation:
+            return True
+        return len(gallery.matrix) - self.size > self.tail_ratio * max(self.size, 1)
+
+    def _sketch(self, matrix):
+        """Project rows into the centered, normalized sketch space"""
+        return _normalize(matrix @ self.projection - self.mean)
+
+    def build(self, gallery):
+        start = time.time()
+        rng = np.random.default_rng(self.seed)
+
+        # Fixed Gaussian projection, scaled so inner products are preserved on average
+        width = gallery.width
+        self.projection = (rng.standard_normal((width, self.dim)) / np.sqrt(self.dim)).astype(np.float32)
+
+        # Consistent view: compaction swaps the buffers and renumbers rows
+        with gallery._lock:
+            matrix = gallery.matrix
+            rows = np.flatnonzero(gallery.alive)
+            generation = gallery.generation
+
+        # Sketch in chunks to avoid copying the whole gallery at once
+        raw = np.empty((len(rows), self.dim), dtype=np.float32)
+        for chunk in range(0, len(rows), 1024):
+            raw[chunk:chunk + 1024] = matrix[rows[chunk:chunk + 1024]] @ self.projection
+        self.mean = raw.mean(axis=0) if len(rows) else np.zeros(self.dim, dtype=np.float32)
+        codes = _normalize(raw - self.mean)
+
+        # Spherical k-means on the sketches
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(rows))))
+        n_lists = max(1, min(n_lists, len(rows)))
+        centroids = codes[rng.choice(len(rows), n_lists, replace=False)] if len(rows) else np.zeros((1, self.dim), np.float32)
+        assignment = np.zeros(len(rows), dtype=np.intp)
+        for _ in range(self.iterations if len(rows) else 0):
+            assignment = np.argmax(codes @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, codes)
+            counts = np.bincount(assignment, minlength=len(centroids))
+            # Re-seed empty clusters from random rows
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = codes[rng.choice(len(rows), len(empty))]
+            centroids = _normalize(sums)
+
+        # Store the sketches contiguously per list
+        order = np.argsort(assignment, kind='stable')
+        self.centroids = centroids.astype(np.float32)
+        self.rows = rows[order]
+        self.codes = np.ascontiguousarray(codes[order], dtype=np.float32)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))))
+
+        self.gallery = gallery
+        self.generation = generation
+        self.size = len(matrix)
+        log.info("ANN index: %d rows in %d lists (%.2fs)", len(rows), len(centroids), time.time() - start)
+        return self
+
+    def search(self, probe, k=1, n_probe=ANN_PROBES, rerank=ANN_RERANK):
+        """Return up to k (gallery row, cosine similarity) pairs, best first"""
+        if n_probe < 1 or rerank < 1:
+            raise ValueError("n_probe and rerank must be at least 1")
+        gallery = self.gallery
+        probe = np.asarray(probe, dtype=np.float32).ravel()
+        probe = probe / (np.linalg.norm(probe) or 1.0)
+        if gallery is None or len(gallery) == 0:
+            return []
+
+        # Closest lists in sketch space
+        code = self._sketch(probe[None, :])[0]
+        n_probe = max(1, min(n_probe, len(self.centroids)))
+        lists = np.argpartition(-(self.centroids @ code), n_probe - 1)[:n_probe]
+
+        candidates = [self.rows[self.offsets[i]:self.offsets[i + 1]] for i in lists]
+        approx = [self.codes[self.offsets[i]:self.offsets[i + 1]] @ code for i in lists]
+
+        candidates = np.concatenate(candidates)
+        approx = np.concatenate(approx)
+        if len(candidates) > rerank:
+            keep = np.argpartition(-approx, rerank - 1)[:rerank]
+            candidates = candidates[keep]
+
+        # Rows appended after the build are not in any list: re-rank all of them too
+        tail = np.arange(self.size, len(gallery.matrix))
+        candidates = np.concatenate((candidates, tail))
+
+        # Exact re-rank on the live rows
+        candidates = candidates[gallery.alive[candidates]]
+        if len(candidates) == 0:
+            return []
+        scores = gallery.matrix[candidates] @ probe
+        best = np.argsort(-scores)[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in best]
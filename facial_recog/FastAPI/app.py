@@ -1,20 +1,32 @@
 import os
-from fastapi import FastAPI, File, UploadFile, Form
+import asyncio
+from fastapi import FastAPI, File, UploadFile, Form, Request, Response, Header
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from tempfile import NamedTemporaryFile
 from pydantic import BaseModel
 import requests
-import cv2
 import mediapipe as mp
 import numpy as np
 from typing import List, Optional
 from sklearn.metrics.pairwise import cosine_similarity
 import os
 import json
+import hmac
+import threading
 from supabase import create_client, Client, acreate_client, AsyncClient
-# Import the class from the face.py
-from face import MediaPipeFaceRecognizer
+from gallery import Gallery, GalleryDrift, parse_encoding, fetch_rows
+from ann_index import IVFIndex, ANN_ENABLED, ANN_PROBES, ANN_RERANK
+from face import best_match, normalize_rows, aggregate_scores, assign_faces, to_gallery_matrix, rank_students
+import workers
+import fetch
+from batcher import MicroBatcher
+from encoding_cache import EncodingCache, ENCODING_CACHE_ENABLED, content_hash
+from shared_gallery import GALLERY_SHARED, GalleryPublisher, GalleryReader
+from projection import PCAProjection
+from encoding_format import to_text, encode_body, EncodingFormatError
+from log import get_logger, summarize
 from dotenv import load_dotenv
 import requests
 from contextlib import asynccontextmanager
@@ -23,6 +35,8 @@ from contextlib import asynccontextmanager
 # Load the .env
 load_dotenv()
 
+log = get_logger("app")
+
 # Set the max size
 size = 2 * 1024 * 1024
 
@@ -31,9 +45,6 @@ url = "https://wbkosuecqbsgwrkdtlux.supabase.co"# os.getenv("SUPABASE_URL")
 api = os.getenv("SUPABASE_API")
 supabase: Client = create_client(url, api)
 
-# Run function
-mpfr = MediaPipeFaceRecognizer()
-
 
 # For preloads
 encodings = []
@@ -54,45 +65,154 @@ encodings = []
 
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.state.gallery = Gallery.empty()
+app.state.ann_index = None
+
+# Concurrent /get_similarity_2 probes are scored together
+batcher = MicroBatcher()
+
+# Shared gallery across workers: one publisher, the rest are readers
+app.state.publisher = None
+app.state.reader = None
+
+
+def currentGallery():
+    """The gallery requests should use (the shared view in reader workers)"""
+    reader = app.state.reader
+    return reader.get() if reader else app.state.gallery
 
 
 # Preload encoding
 def getEncodings():
     # Get the encodings
     try:
-        response = (
-            supabase
-            .table('student_image')
-            .select('user_id, encoding, student(student_no)')
-            # .eq('student(student_id)', 'user_id')
-            .execute()
-        )
-        app.state.encodings = response.data
-        encodings = app.state.encodings
-        print('List: ', len(encodings))
+        rows = fetch_rows(supabase)
+        # Reduced space if a projection has been fitted (see projection.py)
+        projection = PCAProjection.load()
+        if projection:
+            log.info('Projection v%s: %d dims', projection.version, projection.dim)
+
+        # Parse once into a normalized float32 matrix
+        app.state.gallery = Gallery.from_rows(rows, projection=projection)
+        log.info('Gallery: %d encodings', len(app.state.gallery))
+
+        # Campus-wide index, if enabled
+        if ANN_ENABLED:
+            app.state.ann_index = IVFIndex().build(app.state.gallery)
+
+        # Hand the new gallery to the other workers
+        if app.state.publisher:
+            app.state.publisher.publish(app.state.gallery)
         
         # await getModuleStudents(std_ids=std_ids)
     except Exception as e:
-        print('Encoding preloads exception: ',e)
+        log.error('Encoding preloads exception: %s', e)
+
+
+# Shared secret for /reload_encodings (X-Reload-Token); unset disables the endpoint
+RELOAD_TOKEN = os.getenv("RELOAD_TOKEN", "")
+
+# One full reload at a time
+reload_lock = threading.Lock()
+
+
+def reloadEncodings():
+    """getEncodings unless a reload is already running; False if skipped"""
+    if not reload_lock.acquire(blocking=False):
+        return False
+    try:
+        getEncodings()
+        return True
+    finally:
+        reload_lock.release()
+
+def getImageRow(record):
+    """Resolve (image_id, user_id, student_no, encoding) for a changed student_image record"""
+    image_id = record.get('image_id')
+    user_id = record.get('user_id')
+    student_no = app.state.gallery.student_no_for(user_id)
+
+    # Realtime can leave out large column values, so fetch the row when needed
+    encoding = parse_encoding(record.get('encoding'))
+    if encoding is None or student_no is None:
+        row = (
+            supabase
+            .table('student_image')
+            .select('image_id, user_id, encoding, student(student_no)')
+            .eq('image_id', image_id)
+            .execute()
+        ).data
+        if not row:
+            return image_id, user_id, student_no, None
+        user_id = row[0].get('user_id')
+        student_no = (row[0].get('student') or {}).get('student_no')
+        encoding = parse_encoding(row[0].get('encoding'))
+
+    return image_id, user_id, student_no, encoding
+
 
 def getPayload(paylaod):
     # Subscription
     if not paylaod:
-        print('Payload from subscription: Nothing to show')
-        
-    record = paylaod['data']['record']
-    print('Payload from subscription: ', record)
+        log.debug('Payload from subscription: Nothing to show')
+        return
 
-    # Fetch new data
-    getEncodings()
+    data = paylaod.get('data', paylaod)
+    event = data.get('type') or data.get('eventType')
+    record = data.get('record') or {}
+    old_record = data.get('old_record') or {}
+    log.info('Payload from subscription: %s %s', event, record.get('image_id') or old_record.get('image_id'))
 
-    # get the student number
-    # try:
-    #     data: str = supabase.table('student').select('student_no').eq('student_id', record['user_id']).single().execute()
-    #     student_no = extract_student_no(data)
-    #     print('STudent number: ', student_no)
-    # except Exception as e:
-    #     print('Exception from student no [new image]: ', e)
+    # Apply the change to the in-memory gallery
+    gallery = app.state.gallery
+    try:
+        if event == 'DELETE':
+            # Rows skipped at load time (no usable encoding) were never in the gallery
+            if old_record.get('image_id') not in gallery.rows_by_image:
+                log.debug('Delete for image %s not in the gallery', old_record.get('image_id'))
+                return
+            gallery.remove(old_record.get('image_id'))
+            if app.state.publisher:
+                app.state.publisher.schedule()
+            return
+
+        image_id, user_id, student_no, encoding = getImageRow(record)
+        if encoding is None:
+            log.warning('No usable encoding for image %s', image_id)
+            if event == 'UPDATE' and image_id in gallery.rows_by_image:
+                gallery.remove(image_id)
+            return
+
+        if event == 'INSERT':
+            gallery.add(image_id, user_id, student_no, encoding)
+        elif event == 'UPDATE' and image_id not in gallery.rows_by_image:
+            # Skipped at load time, and usable now
+            gallery.add(image_id, user_id, student_no, encoding)
+        elif event == 'UPDATE':
+            gallery.update(image_id, user_id, student_no, encoding)
+        log.debug('Gallery size: %d', len(gallery))
+
+        if app.state.publisher:
+            app.state.publisher.schedule()
+
+    except GalleryDrift as e:
+        # We missed an event somewhere, start over from the table
+        log.warning('Gallery drift, reloading encodings: %s', e)
+        reloadEncodings()
+    except Exception as e:
+        log.error('Exception while applying change: %s', e)
+
+
+# Only resync on reconnects, the first SUBSCRIBED follows the startup preload
+subscribed_once = False
+
+def getSubscribeStatus(status, error=None):
+    global subscribed_once
+    log.info('Subscription status: %s %s', status, error or '')
+    if str(status).endswith('SUBSCRIBED'):
+        if subscribed_once:
+            reloadEncodings()
+        subscribed_once = True
 
 
 import ast
@@ -113,24 +233,64 @@ def extract_student_no(raw_str):
 
 @app.on_event('startup')
 async def preload_and_subscribe():
-    supabase_async: AsyncClient = await acreate_client(url, api)
+    # Decode / detect / encode run in worker processes
+    workers.start()
+
+    # With a shared gallery only one worker loads and subscribes
+    if GALLERY_SHARED:
+        publisher = GalleryPublisher(lambda: app.state.gallery)
+        if not publisher.acquire():
+            app.state.reader = GalleryReader()
+            log.info('Reading the shared gallery published by another worker')
+            return
+        app.state.publisher = publisher
+
+    supabase_async = await getAsyncClient()
     if not supabase_async:
-        print('Supabase is not initialized')
+        log.error('Supabase is not initialized')
         # return {"":"", "":"", "":""}
 
     # Get the encodings
     getEncodings()
 
-    # Subscribe to table insert
+    # Subscribe to table changes
     try:
         response = (
             await supabase_async.channel('student_image')
-            .on_postgres_changes("INSERT", schema="public", table="student_image", callback=getPayload)
-            .subscribe()
+            .on_postgres_changes("*", schema="public", table="student_image", callback=getPayload)
+            .subscribe(getSubscribeStatus)
         )
 
     except Exception as e:
-        print('Exception for subscription: ', e)
+        log.error('Exception for subscription: %s', e)
+
+@app.post('/reload_encodings')
+async def reload_encodings(x_reload_token: Optional[str] = Header(None)):
+    """Full reload, e.g. after refitting the projection with projection.py"""
+    if not RELOAD_TOKEN or not hmac.compare_digest(x_reload_token or "", RELOAD_TOKEN):
+        return JSONResponse(status_code=403, content={"error": "Invalid reload token"})
+
+    if app.state.reader:
+        gallery = currentGallery()
+        return {"error": "Reloads run in the publishing worker", "encodings": len(gallery), "dim": gallery.width}
+
+    # Fetch, parse and index in a thread so other requests keep being served
+    if not await asyncio.to_thread(reloadEncodings):
+        return JSONResponse(status_code=409, content={"error": "A reload is already running"})
+    gallery = app.state.gallery
+    return {"encodings": len(gallery), "dim": gallery.width}
+
+
+@app.get('/metrics/batching')
+async def batching_metrics():
+    return batcher.stats()
+
+
+@app.on_event('shutdown')
+async def stop_workers():
+    workers.shutdown()
+    await fetch.close()
+
 
 class ImageURL(BaseModel):
     url: str
@@ -145,93 +305,245 @@ class SimilarityResponse(BaseModel):
     error: Optional[str]=None
 
 
-@app.post("/get_encoding")
-async def transcribe(data: ImageURL):
-    # Download image from URL
-    response = requests.get(data.url)
-    if response.status_code != 200:
-        return "Failed to fetch image"
-    
-    # Convert to NumPy array
-    image_array = np.frombuffer(response.content, np.uint8)
-    image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+# Encodings already computed for a URL or for identical bytes
+encoding_cache = EncodingCache() if ENCODING_CACHE_ENABLED else None
+
+
+async def getUrlEncoding(url):
+    """Encoding for an image URL as (encoding, error), from the cache when it is still valid"""
+    # sqlite calls run in threads so a busy cache never stalls the event loop
+    entry = await asyncio.to_thread(encoding_cache.lookup, url) if encoding_cache else None
+    if entry and entry.fresh:
+        await asyncio.to_thread(encoding_cache.touch, url)
+        return entry.encoding, None
+
+    # Download image from URL (pooled, time- and size-bounded), conditionally if cached
+    try:
+        response = await fetch.fetch(url, headers=entry.conditional_headers() if entry else None)
+    except fetch.FetchError as e:
+        return None, str(e)
+
+    if response.status == 304 and entry:
+        await asyncio.to_thread(encoding_cache.touch, url, validated=True)
+        return entry.encoding, None
+
+    # Same bytes under another URL: skip the detector
+    digest = content_hash(response.content)
+    result = await asyncio.to_thread(encoding_cache.lookup_content, digest) if encoding_cache else None
+    if result is None:
+        # Decode and encode in a worker
+        result, error = await workers.run(workers.encode_face, response.content)
+        if result is None:
+            return None, error
+
+    if encoding_cache:
+        await asyncio.to_thread(
+            encoding_cache.store, url, result,
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+            digest=digest,
+        )
+    return result, None
 
-    # Run functon
-    result = mpfr._extract_single_encoding(image)
+
+@app.post("/get_encoding")
+async def transcribe(data: ImageURL, request: Request):
+    result, error = await getUrlEncoding(data.url)
 
     # Check error
     if result is None:
-        return {"error": "No face detected"}
+        return {"error": error}
 
     # Print
-    print("Encoding", result)
-    print("Type of result:", type(result))
+    log.debug("Encoding %s", summarize(result))
+
+    # Binary (compact or .npy) or compact text on request, JSON float list otherwise
+    accept = request.headers.get("accept", "")
+    try:
+        body = encode_body(result, accept)
+    except EncodingFormatError as e:
+        return {"error": str(e)}
+    if body is not None:
+        return Response(content=body[0], media_type=body[1])
+    if "encoding=compact" in accept:
+        return {"encoding": to_text(result)}
 
     return {"encoding": result.tolist()}
 
 
+# Images downloaded and encoded at once by /get_encodings, and the most per request
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", str(max(4, 2 * workers.WORKER_PROCESSES))))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+
+class BulkItem(BaseModel):
+    url: str
+    id: Optional[str] = None
+
+class BulkImageURLs(BaseModel):
+    items: List[BulkItem]
+    format: str = "compact"
+
+
+async def streamEncodings(items, format):
+    """NDJSON lines, one per item, in the order they finish"""
+    pending = asyncio.Queue()
+    for index, item in enumerate(items):
+        pending.put_nowait((index, item))
+    done = asyncio.Queue()
+
+    async def runner():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            line = {"index": index, "id": item.id, "url": item.url}
+            try:
+                result, error = await getUrlEncoding(item.url)
+            except Exception as e:
+                result, error = None, str(e)
+            if result is None:
+                line["error"] = error
+            elif format == "json":
+                line["encoding"] = result.tolist()
+            else:
+                line["encoding"] = to_text(result)
+            await done.put(line)
+
+    tasks = [asyncio.create_task(runner()) for _ in range(min(BULK_CONCURRENCY, len(items)))]
+    try:
+        for _ in range(len(items)):
+            yield json.dumps(await done.get()) + "\n"
+    finally:
+        # Client went away (or we are done): stop downloading
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/get_encodings")
+async def transcribe_bulk(data: BulkImageURLs):
+    if len(data.items) > BULK_MAX_ITEMS:
+        return {"error": f"Too many items. Maximum is {BULK_MAX_ITEMS} per request"}
+    if data.format not in ("compact", "json"):
+        return {"error": "format must be 'compact' or 'json'"}
+    log.info("Bulk encodings: %d", len(data.items))
+    return StreamingResponse(streamEncodings(data.items, data.format), media_type="application/x-ndjson")
+
+
 # Increase the maximum file size limit (e.g., 10MB)
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB in bytes
 
+# Similarity threshold for a positive identification
+MATCH_THRESHOLD = 0.6
 
-def getKnonwFaces(student_numbers):
-    if not supabase:
-        print("Supabase not initialized")    
 
-    # Check the type 
-    arr = np.array(student_numbers)
-    std_no = arr.astype(int) # [int(x) for x in student_numbers]
-    print("Out", std_no)
+# Ids per `in` query, and rows per page within one query
+KNOWN_FACES_CHUNK = 100
+KNOWN_FACES_PAGE = 200
 
-    # Get the know faces for these std numbers
-    known_faces = []
-    try:
-        for x in student_numbers:
-            encoding = supabase.table("student_image").select("encoding").eq("user_id", x).execute()
-            encodings = [row["encoding"] for row in encoding.data if "encoding" in row]
-            # for y in encodings:
-            #     known_faces.insert(np.array(y))
-            #     with open ("encodings.txt", "a") as file:
-            #         print(f"\n{y}\n", file=file)
-            
-            known_faces.extend(encodings)
-            # with open ("encodings.txt", "a") as file:
-            #     print(f"\n{known_faces}\n", file=file)
-            print(f"Length from supabase: {len(known_faces)}")
+# Shared async client (its HTTP connection pool is reused by every request)
+supabase_async: Optional[AsyncClient] = None
 
+async def getAsyncClient():
+    global supabase_async
+    if supabase_async is None:
+        supabase_async = await acreate_client(url, api)
+    return supabase_async
+
+
+async def fetchKnownFacesChunk(client, ids):
+    # One set-based query, paged in case the chunk has many images
+    rows = []
+    start = 0
+    while True:
+        response = await (
+            client
+            .table("student_image")
+            .select("user_id, encoding")
+            .in_("user_id", ids)
+            .order("image_id")
+            .range(start, start + KNOWN_FACES_PAGE - 1)
+            .execute()
+        )
+        rows.extend(response.data)
+        if len(response.data) < KNOWN_FACES_PAGE:
+            return rows
+        start += KNOWN_FACES_PAGE
+
+
+async def getKnonwFaces(student_numbers):
+    client = await getAsyncClient()
+    if not client:
+        log.error("Supabase not initialized")
+        return []
+
+    # Get the know faces for these std numbers, a few `in` queries at once
+    try:
+        chunks = [
+            student_numbers[i:i + KNOWN_FACES_CHUNK]
+            for i in range(0, len(student_numbers), KNOWN_FACES_CHUNK)
+        ]
+        results = await asyncio.gather(*(fetchKnownFacesChunk(client, chunk) for chunk in chunks))
+
+        # Keep the old per-student ordering
+        by_student = {}
+        skipped = 0
+        for rows in results:
+            for row in rows:
+                try:
+                    encoding = parse_encoding(row.get("encoding"))
+                except (ValueError, TypeError) as e:
+                    log.debug("Skipping unreadable encoding for %s: %s", row.get("user_id"), e)
+                    encoding = None
+                if encoding is None:
+                    skipped += 1
+                    continue
+                by_student.setdefault(row["user_id"], []).append(encoding)
+        if skipped:
+            log.warning("Skipped %d unusable known-face encodings", skipped)
+        known_faces = [encoding for x in student_numbers for encoding in by_student.get(x, [])]
+
+        log.debug("Length from supabase: %d (%d queries)", len(known_faces), len(chunks))
         return known_faces
     except Exception as error:
-        print("Error while fetching table contents: ", str(error))
+        log.error("Error while fetching table contents: %s", error)
+        return []
 
 
-async def getModuleStudents(std_ids):
+async def getModuleStudents(std_ids, gallery=None):
     # Check encoding first
-    encodings = app.state.encodings
-    print('Get module students: ', len(encodings))
-    if len(encodings) == 0:
-        print('No encodings')
-        raise 'Encodings list is empty'
-
-    # Filter the preloaded encodings
-    filtered = [
-        entry
-        for entry in encodings
-        if entry["user_id"] in std_ids
-    ]
-    students = [
-        entry['student']['student_no']
-        for entry in filtered
-    ]
-    images = [
-        entry['encoding'] 
-        for entry in filtered
-    ]
-
-    print('Students list: ', len(students))
-    print('Images list: ', len(images))
+    if gallery is None:
+        gallery = currentGallery()
+    log.debug('Get module students: %d', len(gallery))
+    if len(gallery) == 0:
+        log.warning('No encodings')
+        return [], None
+
+    # Index into the preloaded gallery
+    students, images = gallery.select(std_ids)
+
+    log.debug('Students list: %d', len(students))
+    log.debug('Images list: %d', len(images))
 
     return students, images
 
+def getAnnIndex(gallery):
+    """Campus-wide index over the preloaded gallery, rebuilt when it went stale"""
+    index = app.state.ann_index
+    if index is None or index.is_stale(gallery):
+        index = IVFIndex().build(gallery)
+        app.state.ann_index = index
+    return index
+
+def matchProbe(probe, known_faces_encoding, student_numbers, normalized=False):
+    """Best student for a probe encoding, thresholded like _recognize_face_modified"""
+    gallery = to_gallery_matrix(known_faces_encoding, width=len(probe))
+    index, confidence = best_match(probe, gallery, normalized)
+    if index < 0:
+        return "Unknown", 0.0
+    name = student_numbers[index] if confidence >= MATCH_THRESHOLD else "Unknown"
+    return name, confidence
+
 def getFaces():
     url = os.getenv("SUPABASE_URL")
     api_key = os.getenv("SUPABASE_API")
@@ -242,8 +554,8 @@ def getFaces():
 
     response = requests.get(f"https://wbkosuecqbsgwrkdtlux.supabase.co/rest/v1/student_image", headers=headers)
 
-    print("Status Code:", response.status_code)
-    print("Response:", response.text)
+    log.info("Status Code: %s", response.status_code)
+    log.debug("Response: %s", response.text)
 
 
 @app.post("/get_similarity")
@@ -258,7 +570,7 @@ async def get_similarity(
         file_size = file.file.tell()
         file.file.seek(0)  # Reset file pointer
         
-        print(f"File size: {file_size} bytes")
+        log.debug("File size: %d bytes", file_size)
         
         if file_size > MAX_FILE_SIZE:
             return {
@@ -276,11 +588,10 @@ async def get_similarity(
         if len(contents) == 0:
             return {"error": "Empty file", "name": "Unknown", "confidence": 0.0}
 
-        image_array = np.frombuffer(contents, np.uint8)
-        image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return {"error": "Invalid image format", "name": "Unknown", "confidence": 0.0}
+        # Decode and encode in a worker
+        probe, error = await workers.run(workers.encode_probe, contents)
+        if probe is None:
+            return {"error": error, "name": "Unknown", "confidence": 0.0}
 
         # check encoding
         # encoding = mpfr._extract_single_encoding_modified(image)
@@ -293,7 +604,7 @@ async def get_similarity(
         student_ids = json.loads(student_ids)
 
         # Known faces]
-        known_faces = getKnonwFaces(student_ids)
+        known_faces = await getKnonwFaces(student_ids)
         if not known_faces:
             return {"error": "Missing known_faces", "name": "Unknown", "confidence": 0.0}
 
@@ -318,13 +629,13 @@ async def get_similarity(
             return {"error": f"Invalid data types in arrays: {str(e)}", "name": "Unknown", "confidence": 0.0}
         
         # Call your recognition logic
-        print("Std no: ", student_numbers.shape)
-        print("Encodings: ", (known_faces_encoding.shape))
-        name, confidence = mpfr._recognize_face_modified(
-            image, known_faces_encoding, student_numbers
+        log.debug("Std no: %s", student_numbers.shape)
+        log.debug("Encodings: %s", summarize(known_faces_encoding))
+        name, confidence = await asyncio.to_thread(
+            matchProbe, probe, known_faces_encoding, student_numbers
         )
         name = str(name)
-        print ({"name": name, "confidence": confidence})
+        log.info("Match: %s (%.3f)", name, confidence)
 
         return {"name": name, "confidence": confidence}
 
@@ -336,14 +647,26 @@ async def get_similarity(
 async def get_similarity_2(
     file: UploadFile = File(...),
     student_ids: str = Form(...),
+    top_k: int = Form(1),
+    aggregate: str = Form("max"),
 ):
+    if aggregate not in ("max", "mean"):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "aggregate must be 'max' or 'mean'", "name": "Unknown", "confidence": 0.0},
+        )
+    if top_k < 1:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "top_k must be at least 1", "name": "Unknown", "confidence": 0.0},
+        )
     try:
         # Check file size before processing
         file.file.seek(0, os.SEEK_END)
         file_size = file.file.tell()
         file.file.seek(0)  # Reset file pointer
         
-        print(f"File size: {file_size} bytes")
+        log.debug("File size: %d bytes", file_size)
         
         if file_size > MAX_FILE_SIZE:
             return {
@@ -361,52 +684,160 @@ async def get_similarity_2(
         if len(contents) == 0:
             return {"error": "Empty file", "name": "Unknown", "confidence": 0.0}
 
-        image_array = np.frombuffer(contents, np.uint8)
-        image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return {"error": "Invalid image format", "name": "Unknown", "confidence": 0.0}
+        # Decode and encode in a worker
+        probe, error = await workers.run(workers.encode_probe, contents)
+        if probe is None:
+            return {"error": error, "name": "Unknown", "confidence": 0.0}
 
         # Parse JSON strings with validation
         if not student_ids:
             return {"error": "Missing student_ids", "name": "Unknown", "confidence": 0.0}
         student_ids = json.loads(student_ids)
 
-        # Known faces]
-        student_no, known_faces = await getModuleStudents(student_ids)
-        if not known_faces:
+        # Known faces
+        gallery = currentGallery()
+        student_numbers, known_faces_encoding = await getModuleStudents(student_ids, gallery)
+        if known_faces_encoding is None or len(known_faces_encoding) == 0:
             return {"error": "Missing known_faces", "name": "Unknown", "confidence": 0.0}
 
-        try:
-            known_faces_encoding = [known_faces] # json.loads(known_faces)
-            student_numbers = (student_no) # json.loads(student_no)
-        except json.JSONDecodeError as e:
-            return {"error": f"Invalid JSON format: {str(e)}", "name": "Unknown", "confidence": 0.0}
+        # Call your recognition logic
+        log.debug("Std no: %s", student_numbers.shape)
+        log.debug("Encodings: %s", summarize(known_faces_encoding))
+        scores = await batcher.score(known_faces_encoding, gallery.prepare_probe(probe))
+        ranked = rank_students(scores, student_numbers, k=max(top_k, 2), aggregate=aggregate)
+        if not ranked:
+            return {"name": "Unknown", "confidence": 0.0}
+
+        # Best student per aggregated score, with the gap to the runner-up
+        name, confidence = ranked[0]
+        margin = confidence - ranked[1][1] if len(ranked) > 1 else confidence
+        if confidence < MATCH_THRESHOLD:
+            name = "Unknown"
+        name = str(name)
+        log.info("Match: %s (%.3f, margin %.3f)", name, confidence, margin)
+
+        return {
+            "name": name,
+            "confidence": confidence,
+            "margin": margin,
+            "candidates": [
+                {"name": str(student), "confidence": score}
+                for student, score in ranked[:top_k]
+            ],
+        }
 
-        # Validate data types and convert
-        if not isinstance(known_faces_encoding, list) or not isinstance(student_numbers, list):
-            return {"error": "known_faces and student_no must be arrays", "name": "Unknown", "confidence": 0.0}
+    except Exception as e:
+        return {"error": f"Processing error: {str(e)}", "name": "Unknown", "confidence": 0.0}
 
-        if len(known_faces_encoding) == 0 or len(student_numbers) == 0:
-            return {"error": "Empty arrays provided", "name": "Unknown", "confidence": 0.0}
 
-        # Convert to appropriate types
-        try:
-            known_faces_encoding = np.array(known_faces)  # [list(map(float, encoding)) for encoding in known_faces_encoding]
-            student_numbers = np.array(student_no).flatten() # [int(num) for num in student_numbers]
-        except (ValueError, TypeError) as e:
-            return {"error": f"Invalid data types in arrays: {str(e)}", "name": "Unknown", "confidence": 0.0}
-        
-        # Call your recognition logic
-        print("Std no: ", student_numbers.shape)
-        print("Encodings: ", (known_faces_encoding.shape))
-        name, confidence = mpfr._recognize_face_modified(
-            image, known_faces_encoding, student_numbers
+def matchGroup(probes, gallery, known_faces_encoding, student_numbers):
+    """Faces x rows in one product, then faces x students, one student per face"""
+    if gallery.projection is not None:
+        probes = gallery.projection.project(probes)
+    scores = normalize_rows(probes) @ known_faces_encoding.T
+    labels, per_student = aggregate_scores(scores, student_numbers)
+    return assign_faces(per_student, labels, MATCH_THRESHOLD)
+
+
+@app.post("/get_attendance_group")
+async def get_attendance_group(
+    file: UploadFile = File(...),
+    student_ids: str = Form(...),
+):
+    """Mark a whole row or room from one photo: every face, one matrix product"""
+    try:
+        # Read and decode image
+        contents = await file.read()
+        if len(contents) == 0:
+            return {"error": "Empty file", "faces": []}
+        if len(contents) > MAX_FILE_SIZE:
+            return {"error": f"File too large. Maximum size is {MAX_FILE_SIZE/1024/1024}MB", "faces": []}
+
+        # Known faces
+        gallery = currentGallery()
+        student_numbers, known_faces_encoding = await getModuleStudents(json.loads(student_ids), gallery)
+        if known_faces_encoding is None or len(known_faces_encoding) == 0:
+            return {"error": "Missing known_faces", "faces": []}
+
+        # Detect and encode every face into one batch, in a worker
+        group, error = await workers.run(workers.encode_group, contents)
+        if group is None:
+            return {"error": error, "faces": []}
+        boxes, probes = group
+
+        matches = await asyncio.to_thread(matchGroup, probes, gallery, known_faces_encoding, student_numbers)
+
+        faces = [
+            {"bbox": list(box), "name": str(name), "confidence": confidence}
+            for box, (name, confidence) in zip(boxes, matches)
+        ]
+        log.info('Group photo: %d faces, %d matched', len(faces), sum(face["name"] != "Unknown" for face in faces))
+        return {"faces": faces}
+
+    except Exception as e:
+        return {"error": f"Processing error: {str(e)}", "faces": []}
+
+
+def identifyProbe(probe, gallery, n_probe, rerank):
+    """
+    Approximate search when the index is enabled, exhaustive otherwise.
+    Returns (student_no, user_id, confidence), student_no None for no match.
+    Rows are resolved under the gallery lock: realtime changes can compact
+    the gallery and renumber them as soon as it is released.
+    """
+    probe = gallery.prepare_probe(probe)
+    # Built outside the lock so realtime updates do not wait on a rebuild
+    index = getAnnIndex(gallery) if ANN_ENABLED else None
+    with gallery._lock:
+        if index is not None and not index.is_stale(gallery):
+            matches = index.search(probe, k=1, n_probe=n_probe, rerank=rerank)
+            row, confidence = matches[0] if matches else (-1, 0.0)
+        else:
+            # Exhaustive, or the gallery changed under the fresh index
+            row, confidence = best_match(probe, gallery.matrix, normalized=True)
+        if row < 0:
+            return None, None, confidence
+        return gallery.student_nos[row], gallery.user_ids[row], confidence
+
+
+@app.post("/identify")
+async def identify(
+    file: UploadFile = File(...),
+    n_probe: int = Form(ANN_PROBES),
+    rerank: int = Form(ANN_RERANK),
+):
+    """Who is this? Searches every enrolled student, no student_ids filter"""
+    if n_probe < 1 or rerank < 1:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "n_probe and rerank must be at least 1", "name": "Unknown", "confidence": 0.0},
         )
-        name = str(name)
-        print ({"name": name, "confidence": confidence})
+    try:
+        # Read and decode image
+        contents = await file.read()
+        if len(contents) == 0:
+            return {"error": "Empty file", "name": "Unknown", "confidence": 0.0}
+        if len(contents) > MAX_FILE_SIZE:
+            return {"error": f"File too large. Maximum size is {MAX_FILE_SIZE/1024/1024}MB", "name": "Unknown", "confidence": 0.0}
 
-        return {"name": name, "confidence": confidence}
+        gallery = currentGallery()
+        if len(gallery) == 0:
+            return {"error": "Missing known_faces", "name": "Unknown", "confidence": 0.0}
+
+        probe, error = await workers.run(workers.encode_probe, contents)
+        if probe is None:
+            return {"error": error, "name": "Unknown", "confidence": 0.0}
+
+        student_no, user_id, confidence = await asyncio.to_thread(identifyProbe, probe, gallery, n_probe, rerank)
+
+        if student_no is None or confidence < MATCH_THRESHOLD:
+            return {"name": "Unknown", "confidence": max(confidence, 0.0)}
+
+        return {
+            "name": str(student_no),
+            "user_id": user_id,
+            "confidence": confidence,
+        }
 
     except Exception as e:
         return {"error": f"Processing error: {str(e)}", "name": "Unknown", "confidence": 0.0}
@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+from collections import deque
+import numpy as np
+
+
+# Probes arriving within the window (or up to the max) share one matrix product
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "2"))
+BATCH_MAX = int(os.getenv("BATCH_MAX", "32"))
+
+
+class MicroBatcher:
+    """
+    Collects probe encodings from concurrent requests and scores each
+    group against its gallery matrix with a single matrix-matrix product.
+
+    Requests for the same class get the same cached gallery slice
+    (Gallery.select), so probes are grouped by matrix identity.
+    """
+
+    def __init__(self, window_ms=BATCH_WINDOW_MS, max_batch=BATCH_MAX):
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._pending = {}
+
+        # Metrics
+        self.batches = 0
+        self.probes = 0
+        self.largest = 0
+        self._sizes = deque(maxlen=1000)
+        self._delays = deque(maxlen=1000)
+
+    async def score(self, matrix, probe):
+        """Cosine scores of one probe against every row of a normalized matrix"""
+        probe = np.asarray(probe, dtype=np.float32).ravel()
+        probe = probe / (np.linalg.norm(probe) or 1.0)
+        if self.window <= 0:
+            return await asyncio.to_thread(np.dot, matrix, probe)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = id(matrix)
+        group = self._pending.get(key)
+        if group is None:
+            group = self._pending[key] = {"matrix": matrix, "items": []}
+            group["timer"] = loop.call_later(self.window, self._flush, key)
+        group["items"].append((probe, future, time.perf_counter()))
+
+        if len(group["items"]) >= self.max_batch:
+            group["timer"].cancel()
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        group = self._pending.pop(key, None)
+        if group is not None:
+            asyncio.ensure_future(self._run(group["matrix"], group["items"]))
+
+    async def _run(self, matrix, items):
+        started = time.perf_counter()
+        for _, _, queued in items:
+            self._delays.append(started - queued)
+        self.batches += 1
+        self.probes += len(items)
+        self.largest = max(self.largest, len(items))
+        self._sizes.append(len(items))
+
+        try:
+            # rows x probes, one BLAS call for the whole batch
+            probes = np.stack([probe for probe, _, _ in items])
+            scores = await asyncio.to_thread(np.dot, matrix, probes.T)
+        except Exception as e:
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for i, (_, future, _) in enumerate(items):
+            if not future.done():
+                future.set_result(scores[:, i])
+
+    def stats(self):
+        """Batch size and queueing delay over the recent batches"""
+        delays = np.array(self._delays) * 1000.0 if self._delays else np.zeros(1)
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "probes": self.probes,
+            "largest_batch": self.largest,
+            "mean_batch": float(np.mean(self._sizes)) if self._sizes else 0.0,
+            "queue_delay_ms_p50": float(np.percentile(delays, 50)),
+            "queue_delay_ms_p99": float(np.percentile(delays, 99)),
+        }
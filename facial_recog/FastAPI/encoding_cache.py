@@ -0,0 +1,158 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from encoding_format import pack, unpack, EncodingFormatError, ENCODER_VERSION
+
+
+# On-disk /get_encoding cache, LRU-evicted past ENCODING_CACHE_MB
+ENCODING_CACHE_ENABLED = os.getenv("ENCODING_CACHE", "1") == "1"
+ENCODING_CACHE_PATH = os.getenv("ENCODING_CACHE_PATH", "encoding_cache.sqlite3")
+ENCODING_CACHE_MB = int(os.getenv("ENCODING_CACHE_MB", "512"))
+
+# Entries validated this recently are used without asking the server again
+ENCODING_CACHE_TTL = float(os.getenv("ENCODING_CACHE_TTL", "3600"))
+
+# Query parameters that change per request without changing the object. Empty by
+# default: a signed URL's token is what authorizes the read, so it stays in the key
+# (new tokens still skip the detector through the content hash after downloading)
+VOLATILE_PARAMS = {p for p in os.getenv("ENCODING_CACHE_VOLATILE_PARAMS", "").split(",") if p}
+
+
+def cache_key(url):
+    """URL without volatile query parameters"""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in VOLATILE_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, encoding, etag, last_modified, validated_at):
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated_at = validated_at
+
+    @property
+    def fresh(self):
+        return time.time() - self.validated_at < ENCODING_CACHE_TTL
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class EncodingCache:
+    """
+    Maps URL (+ ETag / Last-Modified) and content hash to the computed
+    encoding. Rows from another encoder version are never returned.
+    """
+
+    def __init__(self, path=ENCODING_CACHE_PATH, max_bytes=ENCODING_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS encodings (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                encoder_version INTEGER,
+                encoding BLOB,
+                size INTEGER,
+                validated_at REAL,
+                last_used REAL
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS encodings_hash ON encodings (content_hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS encodings_used ON encodings (last_used)")
+        self._db.commit()
+        self._total = self._size()
+
+    def _decode(self, blob):
+        try:
+            return unpack(blob)
+        except EncodingFormatError:
+            return None
+
+    def lookup(self, url):
+        """Entry for this URL, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT encoding, etag, last_modified, validated_at FROM encodings WHERE url = ? AND encoder_version = ?",
+                (cache_key(url), ENCODER_VERSION),
+            ).fetchone()
+        if row is None:
+            return None
+        encoding = self._decode(row[0])
+        return CacheEntry(encoding, row[1], row[2], row[3]) if encoding is not None else None
+
+    def lookup_content(self, digest):
+        """Encoding of identical bytes cached under any URL"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT encoding FROM encodings WHERE content_hash = ? AND encoder_version = ? LIMIT 1",
+                (digest, ENCODER_VERSION),
+            ).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def touch(self, url, validated=False):
+        now = time.time()
+        with self._lock:
+            if validated:
+                self._db.execute(
+                    "UPDATE encodings SET last_used = ?, validated_at = ? WHERE url = ?", (now, now, cache_key(url))
+                )
+            else:
+                self._db.execute("UPDATE encodings SET last_used = ? WHERE url = ?", (now, cache_key(url)))
+            self._db.commit()
+
+    def store(self, url, encoding, etag=None, last_modified=None, digest=None):
+        blob = pack(encoding)
+        now = time.time()
+        key = cache_key(url)
+        with self._lock:
+            # Running byte total; a replaced row gives its old size back
+            old = self._db.execute("SELECT size FROM encodings WHERE url = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO encodings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, etag, last_modified, digest, ENCODER_VERSION, blob, len(blob), now, now),
+            )
+            self._total += len(blob) - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _size(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM encodings").fetchone()[0]
+
+    def _evict(self):
+        # Other workers share the file, so settle the real total before deleting
+        self._total = self._size()
+        target = self.max_bytes * 0.9
+        while self._total > target:
+            # Oldest first, in batches sized from the average entry
+            count = self._db.execute("SELECT COUNT(*) FROM encodings").fetchone()[0]
+            if not count:
+                break
+            n = max(1, int((self._total - target) * count / self._total) + 1)
+            freed = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT size FROM encodings ORDER BY last_used LIMIT ?)", (n,)
+            ).fetchone()[0]
+            self._db.execute(
+                "DELETE FROM encodings WHERE url IN (SELECT url FROM encodings ORDER BY last_used LIMIT ?)", (n,)
+            )
+            self._total -= freed
@@ -0,0 +1,93 @@
+import os
+import asyncio
+from urllib.parse import urlsplit
+import httpx
+
+
+# Timeouts (seconds), size cap and connection limits for image downloads
+FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", "5"))
+FETCH_READ_TIMEOUT = float(os.getenv("FETCH_READ_TIMEOUT", "15"))
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(10 * 1024 * 1024)))
+FETCH_MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", "32"))
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", "8"))
+
+
+class FetchError(Exception):
+    """Download failed, timed out, or was larger than allowed"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class FetchResult:
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+
+_client = None
+_host_limits = {}
+
+
+def get_client():
+    """Shared client, so downloads reuse pooled keep-alive connections"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(FETCH_READ_TIMEOUT, connect=FETCH_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=FETCH_MAX_CONNECTIONS, max_keepalive_connections=FETCH_MAX_CONNECTIONS),
+            follow_redirects=True,
+        )
+    return _client
+
+
+def _host_limit(url):
+    # One slow storage host cannot take every connection
+    host = urlsplit(url).netloc
+    if host not in _host_limits:
+        _host_limits[host] = asyncio.Semaphore(FETCH_PER_HOST)
+    return _host_limits[host]
+
+
+async def fetch(url, headers=None, max_bytes=FETCH_MAX_BYTES):
+    """
+    GET url, streaming the body and giving up once it passes max_bytes.
+    200 and 304 are returned as a FetchResult, anything else raises FetchError.
+    """
+    try:
+        async with _host_limit(url):
+            async with get_client().stream("GET", url, headers=headers) as response:
+                if response.status_code == 304:
+                    return FetchResult(304, response.headers, b"")
+                if response.status_code != 200:
+                    raise FetchError(f"Failed to fetch image (status {response.status_code})", response.status_code)
+
+                length = response.headers.get("content-length")
+                if length and length.isdigit() and int(length) > max_bytes:
+                    raise FetchError(f"Image too large ({int(length)} bytes)", 413)
+
+                content = bytearray()
+                async for chunk in response.aiter_bytes():
+                    content.extend(chunk)
+                    if len(content) > max_bytes:
+                        raise FetchError(f"Image too large (over {max_bytes} bytes)", 413)
+
+                return FetchResult(200, response.headers, bytes(content))
+
+    except httpx.TimeoutException:
+        raise FetchError("Timed out fetching image", 504)
+    except httpx.HTTPError as e:
+        raise FetchError(f"Failed to fetch image: {e}", 502)
+
+
+async def fetch_bytes(url, max_bytes=FETCH_MAX_BYTES):
+    return (await fetch(url, max_bytes=max_bytes)).content
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,343 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+from encoding_format import is_text, from_text, unpack
+from log import get_logger
+
+
+log = get_logger("gallery")
+
+
+# Encodings are flattened 200x200 grayscale crops
+ENCODING_SIZE = 200 * 200
+
+# Bounds for the per-module slice cache
+SLICE_CACHE_SIZE = int(os.getenv("GALLERY_CACHE_SIZE", "16"))
+SLICE_CACHE_BYTES = int(os.getenv("GALLERY_CACHE_MB", "256")) * 1024 * 1024
+
+# Compact once this share of the rows are deleted tombstones
+COMPACT_RATIO = float(os.getenv("GALLERY_COMPACT_RATIO", "0.25"))
+COMPACT_MIN_ROWS = 32
+
+# Rows per request when reading the whole student_image table (PostgREST caps unpaged reads)
+FETCH_PAGE = int(os.getenv("GALLERY_FETCH_PAGE", "1000"))
+
+
+class GalleryDrift(Exception):
+    """Raised when a change event does not match the in-memory gallery"""
+
+
+def parse_encoding(value, width=ENCODING_SIZE):
+    """Turn a stored `encoding` value into a flat float32 array (None if unusable)"""
+    if value is None:
+        return None
+
+    # Compact forms: base64 text, bytea hex from PostgREST, or raw bytes
+    if is_text(value):
+        value = from_text(value)
+    elif isinstance(value, str) and value.startswith('\\x'):
+        value = unpack(bytes.fromhex(value[2:]))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = unpack(value)
+    elif isinstance(value, str):
+        value = json.loads(value)
+
+    encoding = np.asarray(value, dtype=np.float32).ravel()
+    if len(encoding) != width:
+        return None
+    return encoding
+
+
+def fetch_rows(client, columns='image_id, user_id, encoding, student(student_no)', page=FETCH_PAGE):
+    """Every `student_image` row, in stable image_id pages"""
+    rows = []
+    start = 0
+    while True:
+        data = (
+            client
+            .table('student_image')
+            .select(columns)
+            .order('image_id')
+            .range(start, start + page - 1)
+            .execute()
+        ).data
+        rows.extend(data)
+        if len(data) < page:
+            return rows
+        start += page
+
+
+class Gallery:
+    """
+    Preloaded student_image encodings as one contiguous, L2-normalized
+    float32 matrix, with the owner of every row kept in parallel arrays.
+
+    Rows can be appended, replaced and removed in place from realtime
+    change events. Removed rows are zeroed and tombstoned until enough
+    of them pile up to be worth a compaction.
+
+    With a projection (see projection.py) rows are stored in the reduced
+    space, and probes must go through prepare_probe() before matching.
+    """
+
+    def __init__(self, matrix, user_ids, student_nos, image_ids=None, projection=None):
+        size = len(user_ids)
+        if image_ids is None:
+            image_ids = [None] * size
+
+        # Buffers may be larger than the live row count to make appends cheap
+        self._matrix = matrix
+        self._user_ids = np.asarray(user_ids, dtype=object)
+        self._student_nos = np.asarray(student_nos, dtype=object)
+        self._image_ids = np.asarray(image_ids, dtype=object)
+        self._alive = np.ones(size, dtype=bool)
+        self._size = size
+        self.tombstones = 0
+        self.projection = projection
+
+        # Bumped whenever row numbers change (compaction)
+        self.generation = 0
+
+        # user_id -> row numbers, image_id -> row, and an LRU of module slices keyed by id set
+        self._lock = threading.RLock()
+        self._slices = OrderedDict()
+        self._slice_bytes = 0
+        self._build_index()
+
+    @property
+    def matrix(self):
+        return self._matrix[:self._size]
+
+    @property
+    def user_ids(self):
+        return self._user_ids[:self._size]
+
+    @property
+    def student_nos(self):
+        return self._student_nos[:self._size]
+
+    @property
+    def image_ids(self):
+        return self._image_ids[:self._size]
+
+    @property
+    def alive(self):
+        """Mask of rows that are not tombstoned"""
+        return self._alive[:self._size]
+
+    @property
+    def width(self):
+        return self._matrix.shape[1]
+
+    def _build_index(self):
+        with self._lock:
+            self.index = {}
+            self.rows_by_image = {}
+            for row in np.flatnonzero(self.alive).tolist():
+                self.index.setdefault(self._user_ids[row], []).append(row)
+                if self._image_ids[row] is not None:
+                    self.rows_by_image[self._image_ids[row]] = row
+            self._invalidate()
+
+    def _invalidate(self, user_id=None):
+        """Drop cached module slices (only those containing user_id, if given)"""
+        with self._lock:
+            if user_id is None:
+                self._slices.clear()
+                self._slice_bytes = 0
+                return
+            for key in [key for key in self._slices if user_id in key]:
+                _, dropped = self._slices.pop(key)
+                self._slice_bytes -= dropped.nbytes
+
+    def __len__(self):
+        return self._size - self.tombstones
+
+    @classmethod
+    def empty(cls, width=ENCODING_SIZE):
+        return cls(
+            np.empty((0, width), dtype=np.float32),
+            np.empty(0, dtype=object),
+            np.empty(0, dtype=object),
+        )
+
+    @classmethod
+    def from_rows(cls, rows, width=ENCODING_SIZE, projection=None):
+        """Build the gallery from `student_image` rows (image_id, user_id, encoding, student(student_no))"""
+        matrix = np.empty((len(rows), projection.dim if projection else width), dtype=np.float32)
+        user_ids = []
+        student_nos = []
+        image_ids = []
+        pending = []
+        skipped = 0
+
+        def flush():
+            # Project in blocks, one matrix product per block
+            block = np.stack(pending)
+            start = len(user_ids) - len(block)
+            matrix[start:len(user_ids)] = projection.project(block) if projection else block
+            pending.clear()
+
+        for row in rows:
+            try:
+                encoding = parse_encoding(row.get('encoding'), width)
+            except (ValueError, TypeError) as e:
+                log.debug("Skipping unreadable encoding for %s: %s", row.get('user_id'), e)
+                skipped += 1
+                continue
+            if encoding is None:
+                log.debug("Skipping encoding with wrong size for %s", row.get('user_id'))
+                skipped += 1
+                continue
+
+            pending.append(encoding)
+            user_ids.append(row.get('user_id'))
+            student_nos.append((row.get('student') or {}).get('student_no'))
+            image_ids.append(row.get('image_id'))
+            if len(pending) == 1024:
+                flush()
+        if pending:
+            flush()
+        if skipped:
+            log.warning("Skipped %d of %d encodings (unreadable or wrong size)", skipped, len(rows))
+
+        # Drop the unused tail and normalize in place
+        matrix = np.ascontiguousarray(matrix[:len(user_ids)])
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+
+        return cls(matrix, user_ids, student_nos, image_ids, projection=projection)
+
+    def prepare_probe(self, encoding):
+        """Bring a raw probe encoding into the space the gallery rows live in"""
+        if self.projection is None:
+            return encoding
+        return self.projection.project(np.asarray(encoding, dtype=np.float32).ravel())
+
+    def student_no_for(self, user_id):
+        """Student number already known for a user, if any of their images is loaded"""
+        with self._lock:
+            rows = self.index.get(user_id)
+            return self._student_nos[rows[0]] if rows else None
+
+    def _grow(self):
+        capacity = max(16, int(len(self._matrix) * 1.5))
+        matrix = np.zeros((capacity, self.width), dtype=np.float32)
+        matrix[:self._size] = self.matrix
+        self._matrix = matrix
+        for name in ('_user_ids', '_student_nos', '_image_ids'):
+            buffer = np.empty(capacity, dtype=object)
+            buffer[:self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, buffer)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._size] = self.alive
+        self._alive = alive
+
+    def _write_row(self, row, encoding):
+        encoding = self.prepare_probe(encoding)
+        norm = np.linalg.norm(encoding)
+        self._matrix[row] = encoding / norm if norm else encoding
+
+    def add(self, image_id, user_id, student_no, encoding):
+        """Append one encoding (raises GalleryDrift if image_id is already loaded)"""
+        with self._lock:
+            if image_id is not None and image_id in self.rows_by_image:
+                raise GalleryDrift(f'image {image_id} is already in the gallery')
+            if self._size == len(self._matrix):
+                self._grow()
+
+            row = self._size
+            self._write_row(row, encoding)
+            self._user_ids[row] = user_id
+            self._student_nos[row] = student_no
+            self._image_ids[row] = image_id
+            self._alive[row] = True
+            self._size += 1
+
+            self.index.setdefault(user_id, []).append(row)
+            if image_id is not None:
+                self.rows_by_image[image_id] = row
+            self._invalidate(user_id)
+
+    def update(self, image_id, user_id, student_no, encoding):
+        """Replace the encoding (and owner) of an existing image in place"""
+        with self._lock:
+            row = self.rows_by_image.get(image_id)
+            if row is None:
+                raise GalleryDrift(f'image {image_id} is not in the gallery')
+
+            old_user = self._user_ids[row]
+            self._write_row(row, encoding)
+            self._student_nos[row] = student_no
+            if old_user != user_id:
+                self.index[old_user].remove(row)
+                if not self.index[old_user]:
+                    del self.index[old_user]
+                self._user_ids[row] = user_id
+                self.index.setdefault(user_id, []).append(row)
+                self.index[user_id].sort()
+                self._invalidate(old_user)
+            self._invalidate(user_id)
+
+    def remove(self, image_id):
+        """Tombstone an image; compacts once enough rows are dead"""
+        with self._lock:
+            row = self.rows_by_image.pop(image_id, None)
+            if row is None:
+                raise GalleryDrift(f'image {image_id} is not in the gallery')
+
+            user_id = self._user_ids[row]
+            self.index[user_id].remove(row)
+            if not self.index[user_id]:
+                del self.index[user_id]
+            self._matrix[row] = 0.0
+            self._alive[row] = False
+            self.tombstones += 1
+            self._invalidate(user_id)
+
+            if self.tombstones >= COMPACT_MIN_ROWS and self.tombstones > COMPACT_RATIO * self._size:
+                self.compact()
+
+    def compact(self):
+        """Drop tombstoned rows and rebuild the indexes"""
+        with self._lock:
+            keep = np.flatnonzero(self.alive)
+            self._matrix = np.ascontiguousarray(self.matrix[keep])
+            self._user_ids = self.user_ids[keep]
+            self._student_nos = self.student_nos[keep]
+            self._image_ids = self.image_ids[keep]
+            self._alive = np.ones(len(keep), dtype=bool)
+            self._size = len(keep)
+            self.tombstones = 0
+            self.generation += 1
+            self._build_index()
+
+    def select(self, std_ids):
+        """
+        Return (student_nos, matrix) for the rows owned by the given user ids.
+        Slices are cached per (order-independent) id set, so repeat scans
+        for the same class only pay a dict lookup.
+        """
+        key = frozenset(std_ids)
+        with self._lock:
+            cached = self._slices.get(key)
+            if cached is not None:
+                self._slices.move_to_end(key)
+                return cached
+
+            rows = sorted(row for user_id in key for row in self.index.get(user_id, ()))
+            rows = np.array(rows, dtype=np.intp)
+            result = (self._student_nos[rows], self._matrix[rows])
+
+            self._slices[key] = result
+            self._slice_bytes += result[1].nbytes
+            while self._slices and (
+                len(self._slices) > SLICE_CACHE_SIZE or self._slice_bytes > SLICE_CACHE_BYTES
+            ):
+                _, (_, evicted) = self._slices.popitem(last=False)
+                self._slice_bytes -= evicted.nbytes
+
+        return result
@@ -0,0 +1,87 @@
+import os
+import struct
+import cv2
+import numpy as np
+
+
+# Decode large uploads straight to about this long edge (0 = always full size)
+INGEST_LONG_EDGE = int(os.getenv("INGEST_LONG_EDGE", "1280"))
+
+# Group photos keep more pixels, their faces are small
+INGEST_GROUP_LONG_EDGE = int(os.getenv("INGEST_GROUP_LONG_EDGE", "2560"))
+
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_size(contents):
+    """(width, height) from the JPEG or PNG header without decoding, or None"""
+    data = memoryview(contents)
+
+    if len(data) >= 24 and bytes(data[:8]) == b"\x89PNG\r\n\x1a\n":
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height
+
+    if len(data) < 4 or bytes(data[:2]) != b"\xff\xd8":
+        return None
+
+    # Walk the JPEG segments up to the first SOF
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+        if marker in _SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def decode_image(contents, long_edge=INGEST_LONG_EDGE):
+    """
+    Decode an upload, letting libjpeg downscale by 2/4/8 while decoding
+    when the image is much larger than long_edge. Returns (image, scale)
+    where scale maps decoded pixel coordinates back to the original
+    image (original = decoded * scale), or (None, 1.0) if undecodable.
+    """
+    buffer = np.frombuffer(contents, np.uint8)
+    size = image_size(contents) if long_edge else None
+
+    factor = 1
+    if size:
+        original_edge = max(size)
+        while factor < 8 and original_edge / (factor * 2) >= long_edge:
+            factor *= 2
+
+    image = cv2.imdecode(buffer, _REDUCED_FLAGS[factor])
+    if image is None:
+        return None, 1.0
+    if factor == 1 or not size:
+        return image, 1.0
+
+    # Measure from the decoded shape (EXIF rotation may swap the axes)
+    return image, max(size) / max(image.shape[:2])
+
+
+def scale_box(box, scale):
+    """Map an (x, y, w, h) box from decoded pixels back to the original image"""
+    if scale == 1.0:
+        return tuple(box)
+    return tuple(int(round(v * scale)) for v in box)
@@ -0,0 +1,136 @@
+import os
+import time
+import argparse
+import numpy as np
+
+
+# Where the fitted basis lives; matching stays in raw space while it is missing
+PROJECTION_PATH = os.getenv("PROJECTION_PATH", "projection.npz")
+PROJECTION_COMPONENTS = int(os.getenv("PROJECTION_COMPONENTS", "256"))
+
+
+class PCAProjection:
+    """
+    Eigenface-style projection of raw encodings into a few hundred dimensions.
+
+    The basis spans the gallery mean plus its top principal components, so
+    cosine similarity between projected encodings approximates the raw
+    cosine similarity and the existing thresholds keep their meaning.
+    """
+
+    def __init__(self, basis, mean, version=1, n_samples=0, explained=0.0, fitted_at=0.0):
+        self.basis = np.ascontiguousarray(basis, dtype=np.float32)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.version = int(version)
+        self.n_samples = int(n_samples)
+        self.explained = float(explained)
+        self.fitted_at = float(fitted_at)
+
+    @property
+    def dim(self):
+        return self.basis.shape[0]
+
+    @property
+    def input_dim(self):
+        return self.basis.shape[1]
+
+    def project(self, encodings):
+        """Project one encoding or a matrix of encodings (rows) into the basis"""
+        encodings = np.asarray(encodings, dtype=np.float32)
+        return encodings @ self.basis.T
+
+    @classmethod
+    def fit(cls, matrix, n_components=PROJECTION_COMPONENTS, oversample=16, power_iters=2, seed=0, version=1):
+        """Fit on a (samples x 40000) matrix with a randomized SVD of the centered data"""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n_samples, width = matrix.shape
+        n_components = max(1, min(n_components, n_samples - 1, width - 1))
+        rng = np.random.default_rng(seed)
+
+        # Range finder on X - mean, without materializing the centered copy
+        mean = matrix.mean(axis=0)
+        omega = rng.standard_normal((width, n_components + oversample)).astype(np.float32)
+        sample = matrix @ omega - mean @ omega
+        for _ in range(power_iters):
+            q, _ = np.linalg.qr(sample)
+            q, _ = np.linalg.qr(matrix.T @ q - np.outer(mean, q.sum(axis=0)))
+            sample = matrix @ q - mean @ q
+        q, _ = np.linalg.qr(sample)
+
+        small = q.T @ matrix - np.outer(q.sum(axis=0), mean)
+        _, singular, vt = np.linalg.svd(small, full_matrices=False)
+        components = vt[:n_components]
+
+        total = float(np.einsum('ij,ij->', matrix, matrix) - n_samples * mean @ mean)
+        explained = float((singular[:n_components] ** 2).sum() / total) if total > 0 else 0.0
+
+        # Orthonormal basis over the mean direction plus the components
+        basis, _ = np.linalg.qr(np.vstack([mean, components]).T)
+        return cls(basis.T, mean, version=version, n_samples=n_samples, explained=explained, fitted_at=time.time())
+
+    def save(self, path=PROJECTION_PATH):
+        """Write the artifact atomically so running servers never read half a file"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as file:
+            np.savez(
+                file,
+                basis=self.basis,
+                mean=self.mean,
+                version=self.version,
+                n_samples=self.n_samples,
+                explained=self.explained,
+                fitted_at=self.fitted_at,
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=PROJECTION_PATH):
+        """Load the artifact at path, or None if there is none"""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(
+                data["basis"],
+                data["mean"],
+                version=data["version"],
+                n_samples=data["n_samples"],
+                explained=data["explained"],
+                fitted_at=data["fitted_at"],
+            )
+
+
+def main():
+    """Refit the basis over the current student_image gallery and save a new version"""
+    from dotenv import load_dotenv
+    from supabase import create_client
+    from gallery import Gallery, fetch_rows
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--components', type=int, default=PROJECTION_COMPONENTS, help='Number of principal components')
+    parser.add_argument('--output', default=PROJECTION_PATH, help='Where to write the artifact')
+    args = parser.parse_args()
+
+    load_dotenv()
+    supabase = create_client("https://wbkosuecqbsgwrkdtlux.supabase.co", os.getenv("SUPABASE_API"))
+
+    print('Fetching encodings...')
+    rows = fetch_rows(supabase)
+    gallery = Gallery.from_rows(rows)
+    print('Encodings: ', len(gallery))
+    if len(gallery) < 2:
+        print('Not enough encodings to fit a projection')
+        return
+
+    previous = PCAProjection.load(args.output)
+    version = previous.version + 1 if previous else 1
+
+    start = time.time()
+    projection = PCAProjection.fit(gallery.matrix, n_components=args.components, version=version)
+    projection.save(args.output)
+    print(f'Saved projection v{projection.version} ({projection.dim} dims, '
+          f'{projection.explained:.1%} variance) to {args.output} in {time.time() - start:.1f}s')
+    print('Servers reproject the gallery on their next encoding reload')
+
+
+if __name__ == "__main__":
+    main()
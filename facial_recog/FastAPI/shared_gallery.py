@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+import numpy as np
+from gallery import Gallery
+from projection import PCAProjection
+from log import get_logger
+
+
+log = get_logger("shared_gallery")
+
+
+# One process publishes, every other uvicorn/gunicorn worker maps it read-only
+GALLERY_SHARED = os.getenv("GALLERY_SHARED", "0") == "1"
+GALLERY_SHM_DIR = os.getenv(
+    "GALLERY_SHM_DIR",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "facetrack-gallery"),
+)
+
+# Realtime bursts are folded into one publish per interval
+PUBLISH_INTERVAL = float(os.getenv("GALLERY_PUBLISH_INTERVAL", "2.0"))
+
+# Generations kept around for readers that are still switching over
+KEEP_GENERATIONS = 2
+
+
+def _path(name):
+    return os.path.join(GALLERY_SHM_DIR, name)
+
+
+def _read_current():
+    try:
+        with open(_path('current.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+class GalleryPublisher:
+    """
+    Writes the gallery into the shared directory as generation N
+    (matrix .npy, metadata .json, optional projection) and then swaps
+    current.json to point at it with an atomic rename.
+
+    `current` returns the gallery to publish when a scheduled publish
+    fires, so a reload in between is never overwritten by an older one.
+    """
+
+    def __init__(self, current):
+        os.makedirs(GALLERY_SHM_DIR, exist_ok=True)
+        self.current = current
+        self._lock_file = None
+        self._timer = None
+        self._timer_lock = threading.Lock()
+        # Reloads and scheduled publishes would otherwise pick the same generation
+        self._publish_lock = threading.Lock()
+
+    def acquire(self):
+        """Try to become the publisher; the lock dies with the process"""
+        lock_file = open(_path('publisher.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def publish(self, gallery):
+        with self._publish_lock:
+            return self._publish(gallery)
+
+    def _publish(self, gallery):
+        start = time.time()
+        current = _read_current()
+        generation = (current['generation'] + 1) if current else 1
+
+        # Snapshot live rows only, chunk by chunk, straight into the mapped file
+        with gallery._lock:
+            rows = np.flatnonzero(gallery.alive)
+            matrix = np.lib.format.open_memmap(
+                _path(f'gallery-{generation}.npy'), mode='w+', dtype=np.float32, shape=(len(rows), gallery.width)
+            )
+            for chunk in range(0, len(rows), 1024):
+                matrix[chunk:chunk + 1024] = gallery.matrix[rows[chunk:chunk + 1024]]
+            matrix.flush()
+            del matrix
+
+            meta = {
+                'user_ids': gallery.user_ids[rows].tolist(),
+                'student_nos': gallery.student_nos[rows].tolist(),
+                'image_ids': gallery.image_ids[rows].tolist(),
+                'projection': gallery.projection is not None,
+            }
+            if gallery.projection is not None:
+                gallery.projection.save(_path(f'projection-{generation}.npz'))
+
+        with open(_path(f'gallery-{generation}.json'), 'w') as file:
+            json.dump(meta, file)
+
+        # Atomic swap
+        fd, tmp = tempfile.mkstemp(prefix='current.', suffix='.tmp', dir=GALLERY_SHM_DIR)
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'generation': generation, 'rows': len(rows), 'published_at': time.time()}, file)
+        os.replace(tmp, _path('current.json'))
+
+        self._cleanup(generation)
+        log.info("Published gallery generation %d: %d rows (%.2fs)", generation, len(rows), time.time() - start)
+        return generation
+
+    def schedule(self):
+        """Publish once PUBLISH_INTERVAL after the first of a burst of changes"""
+        with self._timer_lock:
+            if self._timer is None:
+                self._timer = threading.Timer(PUBLISH_INTERVAL, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        with self._timer_lock:
+            self._timer = None
+        try:
+            self.publish(self.current())
+        except Exception as e:
+            log.exception("Gallery publish failed: %s", e)
+
+    def _cleanup(self, generation):
+        # Readers that still map an old file keep it alive until they let go
+        for name in os.listdir(GALLERY_SHM_DIR):
+            stem, _, _ = name.partition('.')
+            prefix, _, number = stem.rpartition('-')
+            if prefix in ('gallery', 'projection') and number.isdigit():
+                if int(number) <= generation - KEEP_GENERATIONS:
+                    try:
+                        os.remove(_path(name))
+                    except OSError:
+                        pass
+
+
+class GalleryReader:
+    """Read-only, memory-mapped view of the latest published generation"""
+
+    def __init__(self):
+        self.gallery = Gallery.empty()
+        self.generation = 0
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Current gallery, re-attaching when a new generation was published"""
+        try:
+            stamp = os.stat(_path('current.json')).st_mtime_ns
+        except OSError:
+            return self.gallery
+        if stamp == self._stamp:
+            return self.gallery
+
+        with self._lock:
+            current = _read_current()
+            if current and current['generation'] != self.generation:
+                try:
+                    self.gallery = self._attach(current['generation'])
+                    self.generation = current['generation']
+                    log.info("Attached gallery generation %d: %d rows", self.generation, len(self.gallery))
+                except (OSError, ValueError) as e:
+                    # Replaced while we were reading it, try again next time
+                    log.warning("Gallery attach failed: %s", e)
+                    return self.gallery
+            self._stamp = stamp
+        return self.gallery
+
+    def _attach(self, generation):
+        matrix = np.load(_path(f'gallery-{generation}.npy'), mmap_mode='r')
+        with open(_path(f'gallery-{generation}.json')) as file:
+            meta = json.load(file)
+        projection = PCAProjection.load(_path(f'projection-{generation}.npz')) if meta['projection'] else None
+        return Gallery(matrix, meta['user_ids'], meta['student_nos'], meta['image_ids'], projection=projection)
@@ -0,0 +1,105 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from face import MediaPipeFaceRecognizer
+from ingest import decode_image, scale_box, INGEST_GROUP_LONG_EDGE
+from log import get_logger, console_only
+
+
+log = get_logger("workers")
+
+
+# CPU work (decode, detect, encode) runs in these processes; 0 runs it in a thread instead.
+# Every server worker starts its own pool, so the default splits the cores across
+# WEB_CONCURRENCY (what uvicorn/gunicorn --workers read); with --workers N on the
+# command line instead, set WORKER_PROCESSES to cores / N
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+
+# One recognizer (and so one set of detector graphs) per worker process
+_recognizer = None
+_executor = None
+
+
+def _init_worker():
+    global _recognizer
+    _recognizer = MediaPipeFaceRecognizer()
+    _recognizer.encoding_detectors.warm_up(1)
+
+
+def _init_pool_worker():
+    # The server process writes the log file; pool workers log to the console
+    console_only()
+    _init_worker()
+
+
+def _get_recognizer():
+    if _recognizer is None:
+        _init_worker()
+    return _recognizer
+
+
+def _decode(contents):
+    # Reduced-resolution decode; the 200x200 encoders never need 12 MP
+    image, _ = decode_image(contents)
+    return image
+
+
+def encode_probe(contents):
+    """Uploaded photo -> probe encoding (whole image, like _recognize_face_modified)"""
+    image = _decode(contents)
+    if image is None:
+        return None, "Invalid image format"
+    encoding = _get_recognizer()._extract_single_encoding_modified(image)
+    if encoding is None:
+        return None, "No face detected"
+    return encoding, None
+
+
+def encode_face(contents):
+    """Enrollment photo -> encoding of the detected face"""
+    image = _decode(contents)
+    if image is None:
+        return None, "Invalid image format"
+    encoding = _get_recognizer()._extract_single_encoding(image)
+    if encoding is None:
+        return None, "No face detected"
+    return encoding, None
+
+
+def encode_group(contents):
+    """Group photo -> (boxes in original pixels, batch of encodings)"""
+    image, scale = decode_image(contents, INGEST_GROUP_LONG_EDGE)
+    if image is None:
+        return None, "Invalid image format"
+    boxes, encodings = _get_recognizer()._extract_all_encodings(image)
+    if not boxes:
+        return None, "No face detected"
+    return ([scale_box(box, scale) for box in boxes], encodings), None
+
+
+def start():
+    """Start the worker processes (spawned, so they do not inherit the app's clients)"""
+    global _executor
+    if WORKER_PROCESSES > 0 and _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=WORKER_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pool_worker,
+        )
+        log.info("Worker processes: %d", WORKER_PROCESSES)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run(fn, *args):
+    """Await fn(*args) in the worker pool, keeping the event loop free"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, fn, *args)
@@ -0,0 +1,181 @@
+import ast
+import base64
+import struct
+import numpy as np
+
+
+# Bump when _extract_single_encoding changes what an encoding means
+ENCODER_VERSION = 1
+
+# Binary media type for /get_encoding, and the prefix of the text form kept in the DB
+ENCODING_MEDIA_TYPE = "application/x-facetrack-encoding"
+TEXT_PREFIX = "fte1:"
+
+# Plain NumPy arrays (np.save / np.load) are accepted and produced as well
+NPY_MEDIA_TYPE = "application/x-npy"
+_NPY_MAGIC = b"\x93NUMPY"
+
+# magic, format version, dtype code, encoder version, ndim
+_MAGIC = b"FTEN"
+_HEADER = struct.Struct("<4sBBHB")
+_DTYPES = {1: np.uint8, 2: np.float16, 3: np.float32}
+_CODES = {np.dtype(dtype): code for code, dtype in _DTYPES.items()}
+
+
+class EncodingFormatError(ValueError):
+    """Raised for buffers that are not valid compact encodings"""
+
+
+def pack(encoding, dtype=np.uint8, shape=None):
+    """
+    Serialize an encoding to the compact binary format.
+    uint8 stores the 0..1 pixel values as value * 255, which is exact for
+    the grayscale encodings; float16/float32 store the values as they are.
+    """
+    encoding = np.asarray(encoding, dtype=np.float32)
+    shape = tuple(shape or encoding.shape)
+    dtype = np.dtype(dtype)
+    if dtype == np.uint8:
+        data = np.clip(np.rint(encoding * 255.0), 0, 255).astype(np.uint8)
+    else:
+        data = encoding.astype(dtype)
+
+    header = _HEADER.pack(_MAGIC, 1, _CODES[dtype], ENCODER_VERSION, len(shape))
+    dims = struct.pack(f"<{len(shape)}I", *shape)
+    return header + dims + data.astype(data.dtype.newbyteorder("<"), copy=False).tobytes()
+
+
+def unpack(buffer, encoder_version=ENCODER_VERSION):
+    """Decode a compact binary encoding back to a float32 array of its stored shape"""
+    buffer = memoryview(buffer)
+    if len(buffer) < _HEADER.size:
+        raise EncodingFormatError("buffer too short")
+
+    magic, fmt, code, version, ndim = _HEADER.unpack_from(buffer)
+    if magic != _MAGIC or fmt != 1 or code not in _DTYPES:
+        raise EncodingFormatError("not a compact encoding")
+    if encoder_version is not None and version != encoder_version:
+        raise EncodingFormatError(f"encoder version {version}, expected {encoder_version}")
+
+    offset = _HEADER.size + 4 * ndim
+    shape = struct.unpack_from(f"<{ndim}I", buffer, _HEADER.size)
+    dtype = np.dtype(_DTYPES[code]).newbyteorder("<")
+    count = int(np.prod(shape))
+    if len(buffer) - offset != count * dtype.itemsize:
+        raise EncodingFormatError("payload size does not match the header")
+
+    data = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+    if code == 1:
+        return data.astype(np.float32) / 255.0
+    return data.astype(np.float32)
+
+
+def to_text(encoding, dtype=np.uint8):
+    """Text form for JSON responses and the student_image.encoding column"""
+    return TEXT_PREFIX + base64.b64encode(pack(encoding, dtype)).decode("ascii")
+
+
+def is_text(value):
+    return isinstance(value, str) and value.startswith(TEXT_PREFIX)
+
+
+def from_text(value, encoder_version=ENCODER_VERSION):
+    return unpack(base64.b64decode(value[len(TEXT_PREFIX):]), encoder_version)
+
+
+def from_npy(buffer):
+    """
+    Read a .npy buffer without copying the payload (np.frombuffer over the
+    body). Object arrays and pickles are refused.
+    """
+    buffer = memoryview(buffer)
+    if len(buffer) < 10 or bytes(buffer[:6]) != _NPY_MAGIC:
+        raise EncodingFormatError("not a .npy buffer")
+
+    major = buffer[6]
+    if major == 1:
+        header_len = struct.unpack_from("<H", buffer, 8)[0]
+        offset = 10
+    elif major in (2, 3):
+        header_len = struct.unpack_from("<I", buffer, 8)[0]
+        offset = 12
+    else:
+        raise EncodingFormatError(f".npy format version {major} not supported")
+
+    try:
+        header = ast.literal_eval(bytes(buffer[offset:offset + header_len]).decode("latin1"))
+        dtype = np.dtype(header["descr"])
+        shape = tuple(header["shape"])
+        fortran = header["fortran_order"]
+    except (ValueError, SyntaxError, KeyError, TypeError) as e:
+        raise EncodingFormatError(f"bad .npy header: {e}")
+    if dtype.hasobject:
+        raise EncodingFormatError("object arrays are not accepted")
+
+    offset += header_len
+    count = int(np.prod(shape))
+    if len(buffer) - offset != count * dtype.itemsize:
+        raise EncodingFormatError("payload size does not match the header")
+
+    data = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    if fortran:
+        return data.reshape(shape[::-1]).T
+    return data.reshape(shape)
+
+
+def to_npy(encoding, dtype=np.float32):
+    """Serialize to the .npy format, readable with np.load"""
+    data = np.ascontiguousarray(encoding, dtype=dtype)
+    header = repr({"descr": np.lib.format.dtype_to_descr(data.dtype), "fortran_order": False, "shape": data.shape})
+    # Pad so the payload starts on a 64-byte boundary, like np.save does
+    pad = -(10 + len(header) + 1) % 64
+    header = (header + " " * pad + "\n").encode("latin1")
+    return _NPY_MAGIC + b"\x01\x00" + struct.pack("<H", len(header)) + header + data.tobytes()
+
+
+def media_params(value):
+    """Split a Content-Type / Accept entry into (media type, {param: value})"""
+    parts = [part.strip() for part in (value or "").split(";")]
+    params = {}
+    for part in parts[1:]:
+        if "=" in part:
+            key, _, val = part.partition("=")
+            params[key.strip().lower()] = val.strip().strip('"')
+    return parts[0].lower(), params
+
+
+def decode_body(buffer, content_type=None):
+    """
+    Array from a binary request body or form part. The compact format and
+    .npy are recognised by their magic bytes, so a missing or generic
+    content type (application/octet-stream) works too.
+    """
+    head = bytes(memoryview(buffer)[:6])
+    if head.startswith(_MAGIC):
+        return unpack(buffer)
+    if head == _NPY_MAGIC:
+        return from_npy(buffer)
+    media, _ = media_params(content_type)
+    raise EncodingFormatError(f"unsupported encoding body ({media or 'no content type'})")
+
+
+def encode_body(encoding, accept):
+    """
+    (bytes, media type) for the first binary format named in an Accept
+    header, or None when the client wants JSON. A dtype parameter picks
+    uint8 / float16 / float32, e.g. "application/x-npy; dtype=float16".
+    """
+    for entry in (accept or "").split(","):
+        media, params = media_params(entry)
+        if media not in (ENCODING_MEDIA_TYPE, NPY_MEDIA_TYPE):
+            continue
+        try:
+            dtype = np.dtype(params.get("dtype", "uint8" if media == ENCODING_MEDIA_TYPE else "float32"))
+        except TypeError:
+            raise EncodingFormatError(f"unknown dtype {params['dtype']}")
+        if dtype not in _CODES:
+            raise EncodingFormatError(f"dtype {dtype} not supported")
+        if media == ENCODING_MEDIA_TYPE:
+            return pack(encoding, dtype), f"{media}; dtype={dtype}"
+        return to_npy(encoding, dtype), f"{media}; dtype={dtype}"
+    return None
@@ -1,24 +1,177 @@
 import cv2
+import sys
 import mediapipe as mp
 import numpy as np
 import time
 from sklearn.metrics.pairwise import cosine_similarity
 import os
 import shutil
+import queue
+import threading
+from contextlib import contextmanager
+from log import get_logger, summarize
+
+
+log = get_logger("face")
+
+# tracker.py and cadence.py live with the desktop script; only the webcam demo uses them
+FACETRACK_SCRIPTS = os.getenv(
+    "FACETRACK_SCRIPTS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "FaceTrack", "scripts"),
+)
+
+
+def _webcam_helpers():
+    """FaceTracker and DetectionScheduler, imported from FACETRACK_SCRIPTS on first use"""
+    path = os.path.abspath(FACETRACK_SCRIPTS)
+    if path not in sys.path:
+        sys.path.append(path)
+    from tracker import FaceTracker
+    from cadence import DetectionScheduler
+    return FaceTracker, DetectionScheduler
+
+
+# Detectors per pool; defaults to one per core
+DETECTOR_POOL_SIZE = int(os.getenv("DETECTOR_POOL_SIZE", "0")) or os.cpu_count() or 4
+
+
+class DetectorPool:
+    """
+    Pre-initialized MediaPipe FaceDetection graphs that callers borrow
+    for one process() call, so no request builds a graph and no graph is
+    used by two threads at once.
+    """
+
+    def __init__(self, model_selection=0, min_detection_confidence=0.5, size=DETECTOR_POOL_SIZE):
+        self.model_selection = model_selection
+        self.min_detection_confidence = min_detection_confidence
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_detector(self):
+        return mp.solutions.face_detection.FaceDetection(
+            model_selection=self.model_selection,
+            min_detection_confidence=self.min_detection_confidence
+        )
+
+    def warm_up(self, count=None):
+        """Build detectors ahead of time instead of on first use"""
+        with self._lock:
+            while self._created < min(count or self.size, self.size):
+                self._idle.put(self._new_detector())
+                self._created += 1
+
+    @contextmanager
+    def borrow(self):
+        try:
+            detector = self._idle.get_nowait()
+        except queue.Empty:
+            # Grow up to size, then wait for a detector to come back
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            detector = self._new_detector() if create else self._idle.get()
+        try:
+            yield detector
+        finally:
+            self._idle.put(detector)
+
+    def process(self, rgb_image):
+        with self.borrow() as detector:
+            return detector.process(rgb_image)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_detector_pool(model_selection=0, min_detection_confidence=0.5):
+    """Shared pool for one detector configuration"""
+    key = (model_selection, min_detection_confidence)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = DetectorPool(model_selection, min_detection_confidence)
+        return _pools[key]
+
+
+def normalize_rows(matrix):
+    """L2-normalize every row of a 2-D array (all-zero rows stay zero)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def to_gallery_matrix(known_faces_encoding, width=None):
+    """Stack known encodings into one 2-D float32 array, truncated to a common width"""
+    try:
+        matrix = np.asarray(known_faces_encoding, dtype=np.float32)
+    except ValueError:
+        # Ragged rows: cut every row to the shortest one
+        rows = [np.asarray(row, dtype=np.float32).ravel() for row in known_faces_encoding]
+        min_len = min(len(row) for row in rows)
+        matrix = np.stack([row[:min_len] for row in rows])
+
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    if width is not None and matrix.shape[1] > width:
+        matrix = matrix[:, :width]
+    return matrix
+
+
+def encode_face_box(gray_image, box):
+    """
+    Encoding for a face whose (x, y, w, h) box is already known: the same
+    200x200 grayscale crop scaled to 0..1 that _extract_single_encoding
+    makes, without running the detector again. None for an empty crop.
+    """
+    x, y, width, height = box
+    crop = gray_image[y:y + height, x:x + width]
+    if crop.size == 0:
+        return None
+    return (cv2.resize(crop, (200, 200)).astype(np.float32) / 255.0).ravel()
+
+
+def best_match(probe, gallery, normalized=False):
+    """
+    Score a probe encoding against every gallery row with a single
+    matrix-vector product. Returns (row index, cosine similarity),
+    or (-1, -1.0) when there is nothing to compare against.
+    """
+    if gallery is None or len(gallery) == 0:
+        return -1, -1.0
+
+    probe = np.asarray(probe, dtype=np.float32).ravel()
+    min_len = min(len(probe), gallery.shape[1])
+    if min_len == 0:
+        return -1, -1.0
+
+    if not normalized or min_len != gallery.shape[1]:
+        gallery = normalize_rows(gallery[:, :min_len])
+    probe = probe[:min_len]
+    probe_norm = np.linalg.norm(probe)
+    if probe_norm == 0:
+        return -1, -1.0
+
+    scores = gallery @ (probe / probe_norm)
+    index = int(np.argmax(scores))
+    return index, float(scores[index])
 
 
 class MediaPipeFaceRecognizer:
-    def __init__(self, known_faces_folder=None):
+    def __init__(self, known_faces_folder=None, model_selection=0, min_detection_confidence=0.7,
+                 encoding_confidence=0.5):
         """
         Initialize MediaPipe Face Recognition with proper face encoding
         """
-        # Initialize MediaPipe Face Detection
+        # Initialize MediaPipe Face Detection (pooled, shared by every recognizer)
         self.mp_face_detection = mp.solutions.face_detection
         self.mp_drawing = mp.solutions.drawing_utils
-        self.face_detection = self.mp_face_detection.FaceDetection(
-            model_selection=0,
-            min_detection_confidence=0.7
-        )
+        self.face_detection = get_detector_pool(model_selection, min_detection_confidence)
+        self.encoding_detectors = get_detector_pool(0, encoding_confidence)
 
         # Known faces database
         self.known_face_encodings = []
@@ -29,15 +182,19 @@ class MediaPipeFaceRecognizer:
 
         # Performance tracking
         self.fps = 0
-        self.prev_time = time.time()
         self.frame_count = 0
 
+        # Webcam only: faces keep their identity across frames (tracker.py), and full
+        # detection runs as often as the frame-time budget allows (cadence.py)
+        self.tracker = None
+        self.scheduler = None
+
     def _load_known_faces_from_folder(self, folder_path):
         """Load multiple images for each person from folder structure"""
-        print("Loading known faces from folder...")
+        log.info("Loading known faces from folder...")
 
         if not os.path.exists(folder_path):
-            print(f"Folder not found: {folder_path}")
+            log.warning("Folder not found: %s", folder_path)
             return
 
         for person_folder in os.listdir(folder_path):
@@ -46,7 +203,7 @@ class MediaPipeFaceRecognizer:
                 person_name = person_folder.replace('_', ' ')
                 person_encodings = []
 
-                print(f"Loading images for {person_name}...")
+                log.info("Loading images for %s...", person_name)
 
                 # Load all images in the person's folder
                 image_count = 0
@@ -61,30 +218,24 @@ class MediaPipeFaceRecognizer:
                                 if encoding is not None:
                                     person_encodings.append(encoding)
                                     image_count += 1
-                                    print(f"  ✓ Loaded {image_file}")
-                                    with open ("output.txt", "a") as file:
-                                        print("In _load_known_face_from_folder\n", file=file)
-                                        print(f"Personal Encoding {image_path} [{person_encodings.shape}]: {person_encodings}\n", file=file)
+                                    log.info("  ✓ Loaded %s", image_file)
+                                    log.debug("Personal encoding %s: %s", image_path, summarize(encoding))
                                 else:
-                                    print(f"  ✗ No face found in {image_file}")
+                                    log.warning("  ✗ No face found in %s", image_file)
                             else:
-                                print(f"  ✗ Could not read {image_file}")
+                                log.warning("  ✗ Could not read %s", image_file)
                         except Exception as e:
-                            print(f"  ✗ Error processing {image_file}: {e}")
+                            log.warning("  ✗ Error processing %s: %s", image_file, e)
 
                 if person_encodings:
                     # Store all encodings for this person
                     self.known_face_encodings.extend(person_encodings)
                     self.known_face_names.extend([person_name] * len(person_encodings))
-                    print(f"✓ Loaded {image_count} images for {person_name}")
-                    with open ("output.txt", "a") as file:
-                        print("In _load_known_faces_from_folder\n")
-                        print(f"Known Face embedding {image_path}: {self.known_face_encodings}\n", file=file)
-                        print(f"Known face names {image_path}: {self.known_face_names}\n", file=file)
+                    log.info("✓ Loaded %d images for %s", image_count, person_name)
                 else:
-                    print(f"✗ No valid faces found for {person_name}")
+                    log.warning("✗ No valid faces found for %s", person_name)
 
-        print(f"Total loaded: {len(self.known_face_names)} encodings for {len(set(self.known_face_names))} people")
+        log.info("Total loaded: %d encodings for %d people", len(self.known_face_names), len(set(self.known_face_names)))
 
     def _extract_single_encoding(self, image):
         """Extract encoding from a single face image"""
@@ -92,10 +243,7 @@ class MediaPipeFaceRecognizer:
             # Use face detection to find face
             rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-            with self.mp_face_detection.FaceDetection(
-                    model_selection=0, min_detection_confidence=0.5
-            ) as face_detection:
-
+            with self.encoding_detectors.borrow() as face_detection:
                 results = face_detection.process(rgb_image)
 
                 if results.detections:
@@ -127,27 +275,26 @@ class MediaPipeFaceRecognizer:
 
                         # Normalize and flatten as encoding
                         encoding = face_gray.astype(np.float32) / 255.0
-                        with open ("output.txt", "a") as file: 
-                            print("\n\nIn _extract_single_encoding\n", file=file)
-                            print(f"Extracting encodings [{encoding.shape}]: {encoding}\n", file=file)
-                            print(f"Extracting encodings flattened [{encoding.flatten().shape}]: {encoding.flatten()}\n", file=file)
+                        log.debug("Extracted encoding %s", summarize(encoding))
                         return encoding.flatten()
 
             return None
 
         except Exception as e:
-            print(f"Error extracting encoding: {e}")
+            log.warning("Error extracting encoding: %s", e)
             return None
 
-    def _recognize_face(self, face_image):
-        """Recognize face using proper similarity comparison"""
+    def _recognize_face(self, face_image=None, encoding=None):
+        """
+        Recognize face using proper similarity comparison.
+        Pass encoding (see encode_face_box) when the face was already
+        detected, instead of a crop that would be detected again.
+        """
         if len(self.known_face_encodings) == 0:
             return "Unknown", 0.0
 
         # Extract encoding from current face
-        current_encoding = self._extract_single_encoding(face_image)
-        with open ("output.txt", "a") as file: 
-            print(f"\n\nIn _recognize face\n Image => {type(face_image)} \n {type(current_encoding)}", file=file)
+        current_encoding = encoding if encoding is not None else self._extract_single_encoding(face_image)
         if current_encoding is None:
             return "Unknown", 0.0
 
@@ -156,8 +303,6 @@ class MediaPipeFaceRecognizer:
 
         # Compare with all known encodings
         similarities = []
-        with open ("output.txt", "a") as file: 
-            print(f"\n\nIn _recognize face\n Encoding => {type(self.known_face_encodings)}", file=file)
         for i, known_encoding in enumerate(self.known_face_encodings):
             try:
                 # Ensure same length
@@ -165,10 +310,6 @@ class MediaPipeFaceRecognizer:
                 if min_len == 0:
                     continue
 
-                with open ("output.txt", "a") as file: 
-                    print(f"\n\nIn _recognize face\n Known Encoding shape => {(known_encoding.shape)}", file=file)
-                    print(f"\n\nIn _recognize face\n Current Encoding shape => {(current_encoding.shape)}", file=file)
-
                 # Calculate cosine similarity
                 similarity = cosine_similarity(
                     current_encoding[:min_len].reshape(1, -1),
@@ -194,7 +335,7 @@ class MediaPipeFaceRecognizer:
         """Extract encoding from a cropped face image"""
         try:
             if face_image is None or face_image.shape[0] == 0 or face_image.shape[1] == 0:
-                print("Invalid face image")
+                log.warning("Invalid face image")
                 return None
 
             # Resize for consistency
@@ -205,16 +346,12 @@ class MediaPipeFaceRecognizer:
 
             # Normalize and flatten
             encoding = face_gray.astype(np.float32) / 255.0
-
-            with open("output.txt", "a") as file:
-                print("\n\nIn _extract_single_encoding\n", file=file)
-                print(f"Encoding shape: {encoding.shape}\n", file=file)
-                print(f"Flattened shape: {encoding.flatten().shape}\n", file=file)
+            log.debug("Encoding %s", summarize(encoding))
 
             return encoding.flatten()
 
         except Exception as e:
-            print("Encoding error:", str(e))
+            log.warning("Encoding error: %s", e)
             return None
 
     
@@ -225,66 +362,48 @@ class MediaPipeFaceRecognizer:
 
         # Extract encoding from current face
         if face_image is None or face_image.shape[0] == 0 or face_image.shape[1] == 0:
-            print("Invalid face image")
+            log.warning("Invalid face image")
             return "Unknown", 0.0
 
-        print("Extract image encoding ...")
-        face_image_rgb = cv2.cvtColor(face_image, cv2.COLOR_BGR2RGB)
+        log.debug("Extract image encoding ...")
         current_encoding = self._extract_single_encoding_modified(face_image)
         if current_encoding is None:
-            print("\nReached\n")
+            log.debug("No encoding for face image")
             return "Unknown", 0.0
 
-        best_similarity = -1
-        best_name = "Unknown"
-
-        # Compare with all known encodings
-        print("Comparing image encodings ...")
-        # known_faces_encoding = np.array(known_faces_encoding)
-        current_encoding = np.array(current_encoding)
-        similarities = []
-        print("Known Face Encoding type: ", type(known_faces_encoding))
-        for i, known_encoding in enumerate(known_faces_encoding):
-            try:
-                # Ensure same length
-                min_len = min(len(current_encoding), len(known_encoding))
-                if min_len == 0:
-                    print("min_len == 0")
-                    continue
-                
-                # known_encoding_np = np.array(known_encoding)
-                print("Type of known_encoding:", len(known_encoding))
-                print("Type of current_encoding:", (current_encoding.shape))
-                # print("Sample known_encoding:", known_encoding[:5][0])
-
-
-                # Calculate cosine similarity
-                similarity = cosine_similarity(
-                    current_encoding[:min_len].reshape(1, -1),
-                    known_encoding[:min_len].reshape(1, -1)
-                )[0][0]
-
-                similarities.append((similarity, known_faces_id[i]))
-
-            except Exception as e:
-                print(e)
-                continue
+        # Compare with all known encodings in one pass
+        log.debug("Comparing image encodings ...")
+        gallery = to_gallery_matrix(known_faces_encoding, width=len(current_encoding))
+        index, best_similarity = best_match(current_encoding, gallery)
+        if index < 0:
+            return "Unknown", 0.0
 
-        print("Similarity computing ...")
-        if similarities:
-            print("In similarities...")
-            # Find the best match
-            best_similarity, best_name = max(similarities, key=lambda x: x[0])
+        best_name = known_faces_id[index]
 
-            # Apply threshold
-            if best_similarity < 0.7:  # Adjust this threshold as needed
-                best_name = "Unknown"
+        # Apply threshold
+        if best_similarity < 0.7:  # Adjust this threshold as needed
+            best_name = "Unknown"
 
         return best_name, best_similarity
 
     def process_frame(self, frame):
         """Process a single frame for face detection and recognition"""
         self.frame_count += 1
+        started = time.perf_counter()
+        if self.tracker is None:
+            FaceTracker, DetectionScheduler = _webcam_helpers()
+            self.tracker = FaceTracker()
+            self.scheduler = DetectionScheduler()
+
+        # Between detections, carry the tracked boxes forward
+        if not self.scheduler.should_detect(frame):
+            detections = [
+                (*track.int_box, track.name or "Detected", track.confidence)
+                for track in self.tracker.propagate()
+            ]
+            self.scheduler.record(False, time.perf_counter() - started)
+            self.fps = self.scheduler.fps
+            return frame, detections
 
         # Convert BGR to RGB
         rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -292,7 +411,7 @@ class MediaPipeFaceRecognizer:
         # Perform face detection
         results = self.face_detection.process(rgb_frame)
 
-        detections = []
+        boxes = []
 
         if results.detections:
             for detection in results.detections:
@@ -312,22 +431,30 @@ class MediaPipeFaceRecognizer:
                 width = min(w - x, width)
                 height = min(h - y, height)
 
-                # Extract face region for recognition
-                face_region = frame[y:y + height, x:x + width]
-
-                # Recognize face if we have known faces
-                name = "Detected"
-                confidence = 0.0
-
-                if len(self.known_face_encodings) > 0 and face_region.size > 0:
-                    name, confidence = self._recognize_face(face_region)
+                boxes.append((x, y, width, height))
 
-                detections.append((x, y, width, height, name, confidence))
-
-        # Calculate FPS
-        current_time = time.time()
-        self.fps = 1 / (current_time - self.prev_time)
-        self.prev_time = current_time
+        # Recognize only new tracks and tracks due for re-verification
+        tracks = self.tracker.update(boxes)
+        if any(track.hits == 1 for track in tracks):
+            self.scheduler.faces_changed()
+        detections = []
+        gray_frame = None
+        for (x, y, width, height), track in zip(boxes, tracks):
+            if len(self.known_face_encodings) > 0 and self.tracker.needs_identity(track):
+                # Encode straight from the detection box (grayscale once per frame)
+                if gray_frame is None:
+                    gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                encoding = encode_face_box(gray_frame, (x, y, width, height))
+                if encoding is not None:
+                    name, confidence = self._recognize_face(encoding=encoding)
+                    self.tracker.set_identity(track, name, confidence)
+
+            name = track.name or "Detected"
+            detections.append((x, y, width, height, name, track.confidence))
+
+        # Rolling FPS over the last few frames
+        self.scheduler.record(True, time.perf_counter() - started)
+        self.fps = self.scheduler.fps
 
         return frame, detections
 
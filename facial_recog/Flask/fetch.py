@@ -0,0 +1,66 @@
+import os
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Timeouts (seconds), size cap and connection limits for image downloads
+FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", "5"))
+FETCH_READ_TIMEOUT = float(os.getenv("FETCH_READ_TIMEOUT", "15"))
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(10 * 1024 * 1024)))
+FETCH_MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", "32"))
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", "8"))
+
+
+class FetchError(Exception):
+    """Download failed, timed out, or was larger than allowed"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+# Shared session, so downloads reuse pooled keep-alive connections
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=FETCH_MAX_CONNECTIONS, pool_maxsize=FETCH_MAX_CONNECTIONS)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def _host_limit(url):
+    # One slow storage host cannot take every connection
+    host = urlsplit(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(FETCH_PER_HOST)
+        return _host_limits[host]
+
+
+def fetch_bytes(url, max_bytes=FETCH_MAX_BYTES):
+    """GET url, streaming the body and giving up once it passes max_bytes"""
+    try:
+        with _host_limit(url):
+            with _session.get(url, stream=True, timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT)) as response:
+                if response.status_code != 200:
+                    raise FetchError(f"Failed to fetch image (status {response.status_code})", response.status_code)
+
+                length = response.headers.get("content-length")
+                if length and length.isdigit() and int(length) > max_bytes:
+                    raise FetchError(f"Image too large ({int(length)} bytes)", 413)
+
+                content = bytearray()
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    content.extend(chunk)
+                    if len(content) > max_bytes:
+                        raise FetchError(f"Image too large (over {max_bytes} bytes)", 413)
+
+                return bytes(content)
+
+    except requests.Timeout:
+        raise FetchError("Timed out fetching image", 504)
+    except requests.RequestException as e:
+        raise FetchError(f"Failed to fetch image: {e}", 502)
@@ -1,5 +1,4 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, Response, request, jsonify
 import cv2
 import numpy as np
 import os
@@ -9,6 +8,9 @@ from typing import List, Optional
 from face import MediaPipeFaceRecognizer
 from dotenv import load_dotenv
 from werkzeug.exceptions import RequestEntityTooLarge
+import fetch
+from encoding_format import decode_body, encode_body, EncodingFormatError
+from log import get_logger, summarize
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # 16 MB limit
@@ -20,6 +22,8 @@ def request_entity_too_large(error):
 # Load env
 load_dotenv()
 
+log = get_logger("flask_api")
+
 # Initialize Supabase client
 url = "https://wbkosuecqbsgwrkdtlux.supabase.co"
 api_key: str = os.getenv("SUPABASE_API")
@@ -34,7 +38,7 @@ app = Flask(__name__)
 MAX_FILE_SIZE = 1100 * 1024 * 1024  # 10MB in bytes
 
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-print("MAX_CONTENT_LENGTH:", app.config.get('MAX_CONTENT_LENGTH'))
+log.info("MAX_CONTENT_LENGTH: %s", app.config.get('MAX_CONTENT_LENGTH'))
 
 
 # CORS configuration
@@ -52,7 +56,7 @@ def after_request(response):
 def get_similarity():
     try:
         # Check if file is present
-        print('We are in: ', request.files)
+        log.debug('Files: %s', list(request.files))
         if 'file' not in request.files:
             return jsonify({
                 "error": "No file provided", 
@@ -71,12 +75,13 @@ def get_similarity():
             }), 400
 
         # Get JSON data from form
-        print(f'Form : {request.form}')
+        log.debug('Form fields: %s', list(request.form))
+        known_faces_part = request.files.get('known_faces')
         known_faces_json = request.form.get('known_faces')
         student_no_json = request.form.get('student_no')
         
-        if not known_faces_json or not student_no_json:
-            print("Missing known_faces or student_no")
+        if (known_faces_part is None and not known_faces_json) or not student_no_json:
+            log.warning("Missing known_faces or student_no")
             return jsonify({
                 "error": "Missing known_faces or student_no", 
                 "name": "unknown", 
@@ -88,7 +93,7 @@ def get_similarity():
         file_size = file.tell()
         file.seek(0)  # Reset file pointer
         
-        print(f"File size: {file_size} bytes")
+        log.debug("File size: %d bytes", file_size)
         
         if file_size > MAX_FILE_SIZE:
             return jsonify({
@@ -116,24 +121,33 @@ def get_similarity():
                 "confidence": 0.0
             }), 400
 
-        # Parse JSON data
-        print("known_faces raw:", known_faces_json)
-        print("student_no raw:", student_no_json)
+        # Parse known faces (binary .npy / compact file part, or JSON form field)
+        log.debug("student_no raw: %s", student_no_json)
 
         try:
-            known_faces_encoding = json.loads(known_faces_json)
+            if known_faces_part is not None:
+                known_faces_encoding = decode_body(known_faces_part.read(), known_faces_part.mimetype)
+            else:
+                known_faces_encoding = json.loads(known_faces_json)
             student_numbers = json.loads(student_no_json)
         except json.JSONDecodeError as e:
-            print(f"JSON decode error: {str(e)}")
+            log.warning("JSON decode error: %s", e)
             return jsonify({
                 "error": f"Invalid JSON format: {str(e)}", 
                 "name": "unknown", 
                 "confidence": 0.0
             }), 400
+        except EncodingFormatError as e:
+            log.warning("Encoding decode error: %s", e)
+            return jsonify({
+                "error": f"Invalid known_faces encoding: {str(e)}", 
+                "name": "unknown", 
+                "confidence": 0.0
+            }), 400
 
         # Validate data
-        if not known_faces_encoding or not student_numbers:
-            print("Missing known_faces or student_no after parsing")
+        if len(known_faces_encoding) == 0 or not student_numbers:
+            log.warning("Missing known_faces or student_no after parsing")
             return jsonify({
                 "error": "Missing known_faces or student_no", 
                 "name": "unknown", 
@@ -155,7 +169,7 @@ def get_similarity():
         })
 
     except Exception as e:
-        print(f"Error in get_similarity: {str(e)}")
+        log.error("Error in get_similarity: %s", e)
         return jsonify({
             "error": str(e), 
             "name": "unknown", 
@@ -167,7 +181,7 @@ def get_similarity():
 def transcribe():
     try:
         # Check if file is present
-        print(f'We are in')
+        log.debug("Encoding request")
         if "url" not in request.json:
             return jsonify({"error": "No file provided"}), 400
             
@@ -178,26 +192,27 @@ def transcribe():
         if file is None:
             return jsonify({"error": "No file selected"}), 400
 
-        # Download image from URL
-        response = requests.get(file)
-        if response.status_code != 200:
-            return "Failed to fetch image"
+        # Download image from URL (pooled, time- and size-bounded)
+        try:
+            content = fetch.fetch_bytes(file)
+        except fetch.FetchError as e:
+            return jsonify({"error": str(e)}), e.status or 502
         
         # Convert image to NumPy array
-        print('Loading image...')
+        log.debug('Loading image...')
         try:
-            image_array = np.frombuffer(response.content, np.uint8)
+            image_array = np.frombuffer(content, np.uint8)
             image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
             
             if image is None:
                 return jsonify({"error": "Error while image processing"}), 400
                 
         except Exception as e:
-            print(f"Error while image processing: {str(e)}")
+            log.warning("Error while image processing: %s", e)
             return jsonify({"error": "Error while image processing"}), 400
         
         # Parse the arguments
-        print("Passing image")
+        log.debug("Passing image")
         try:
             result = mpfr._extract_single_encoding(image)
             # Check error
@@ -205,16 +220,20 @@ def transcribe():
                 return {"error": "No face detected"}
 
             # Print
-            print("Encoding", result)
-            print("Type of result:", type(result))
+            log.debug("Encoding %s", summarize(result))
+
+            # Binary (compact or .npy) on request, JSON float list otherwise
+            body = encode_body(result, request.headers.get("Accept", ""))
+            if body is not None:
+                return Response(body[0], mimetype=body[1])
 
             return {"encoding": result.tolist()}
         except Exception as e:
-            print(f"Error while parsing args: {str(e)}")
+            log.warning("Error while parsing args: %s", e)
             return jsonify({"error": "Error while parsing args"}), 400
         
     except Exception as e:
-        print(f"Error in transcribe: {str(e)}")
+        log.error("Error in transcribe: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
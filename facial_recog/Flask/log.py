@@ -0,0 +1,219 @@
+import os
+import sys
+import atexit
+import queue
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Root level, and per-module overrides, e.g. LOG_LEVELS="face=DEBUG,app=WARNING"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+
+# Keep this fraction of a module's DEBUG/INFO records, e.g. LOG_SAMPLE="face=0.01"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+
+# Size-bounded log file (empty = console only); replaces the old output.txt appends.
+# One process owns it; other server processes write <name>.<pid><ext>, pool workers the console only
+# (see console_only)
+LOG_FILE = os.getenv("LOG_FILE", "output.txt")
+LOG_FILE_MB = int(os.getenv("LOG_FILE_MB", "10"))
+LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", "3"))
+
+# Full array contents in the log; off means summaries only
+LOG_TRACE = os.getenv("LOG_TRACE", "0") == "1"
+
+# Records waiting for the writer thread; further records are dropped, not waited on
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+_queue_handler = None
+_file_lock = None
+_levels = {}
+_console_only = False
+_setup_lock = threading.Lock()
+
+
+def _parse_pairs(value, convert):
+    pairs = {}
+    for item in value.split(","):
+        name, _, setting = item.partition("=")
+        if name.strip() and setting.strip():
+            pairs[name.strip()] = convert(setting.strip())
+    return pairs
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Never blocks the caller: when the writer falls behind, records are dropped"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _SampleFilter(logging.Filter):
+    """Keeps a fraction of a module's DEBUG/INFO records, warnings always pass"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+def _log_file():
+    """
+    File this process may rotate, or None. Rotating one file from several
+    processes loses lines, so the first process to lock LOG_FILE owns it.
+    """
+    global _file_lock
+    if not LOG_FILE or _console_only:
+        return None
+    if fcntl is None:
+        return LOG_FILE
+
+    lock = open(LOG_FILE + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        root, ext = os.path.splitext(LOG_FILE)
+        return f"{root}.{os.getpid()}{ext}"
+    _file_lock = lock
+    return LOG_FILE
+
+
+def setup():
+    """
+    Route every logger through one queue to a background writer thread,
+    so logging calls on the request path never touch the console or disk.
+    """
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        formatter = logging.Formatter(_FORMAT)
+        handlers = [logging.StreamHandler(sys.stdout)]
+        path = _log_file()
+        if path:
+            handlers.append(RotatingFileHandler(
+                path, maxBytes=LOG_FILE_MB * 1024 * 1024, backupCount=LOG_FILE_BACKUPS, encoding="utf-8",
+                delay=True,
+            ))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        _queue_handler = _DroppingQueueHandler(log_queue)
+        rates = _parse_pairs(LOG_SAMPLE, float)
+        if rates:
+            _queue_handler.addFilter(_SampleFilter(rates))
+
+        # Third-party loggers keep the root's WARNING; levels apply to ours only (get_logger)
+        logging.getLogger().addHandler(_queue_handler)
+        _levels.update(_parse_pairs(LOG_LEVELS, str.upper))
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def _reset():
+    global _listener, _queue_handler, _file_lock
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+    if _file_lock is not None:
+        _file_lock.close()
+    _listener = _queue_handler = _file_lock = None
+
+
+def _after_fork():
+    # The writer thread does not survive fork: start over in the child
+    # (gunicorn workers, fork pools); the lock may have been held mid-fork
+    global _setup_lock
+    _reset()
+    _setup_lock = threading.Lock()
+    setup()
+
+
+def console_only():
+    """
+    Stop writing the log file in this process, e.g. from a process pool
+    initializer: pool workers share the server's console instead.
+    """
+    global _console_only
+    _console_only = True
+    shutdown()
+    _reset()
+    setup()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name):
+    setup()
+    logger = logging.getLogger(name)
+    logger.setLevel(_levels.get(name, LOG_LEVEL))
+    return logger
+
+
+class summarize:
+    """
+    Array wrapper for log arguments. Nothing is computed unless the record
+    is actually written, and then only shape, dtype and a few statistics,
+    unless LOG_TRACE=1 asks for the full contents.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (list, tuple)):
+            if LOG_TRACE or len(value) <= 8:
+                return repr(value)
+            return f"{type(value).__name__}[{len(value)}]"
+        if not isinstance(value, np.ndarray):
+            return repr(value)
+        if LOG_TRACE:
+            return np.array2string(value, threshold=sys.maxsize)
+        if value.size == 0 or value.dtype.kind not in "biuf":
+            return f"array{value.shape} {value.dtype}"
+        return (
+            f"array{value.shape} {value.dtype} "
+            f"min={value.min():.4g} max={value.max():.4g} mean={value.mean():.4g}"
+        )
@@ -6,6 +6,10 @@ import json
 from supabase import create_client, Client
 import os
 from face import MediaPipeFaceRecognizer
+from encoding_format import decode_body, EncodingFormatError
+from log import get_logger, summarize
+
+log = get_logger("routes")
 
 # Initialize Supabase client
 url = "https://wbkosuecqbsgwrkdtlux.supabase.co"
@@ -40,11 +44,12 @@ def get_similarity():
             }), 400
 
         # Get JSON data from form
+        known_faces_part = request.files.get('known_faces')
         known_faces_json = request.form.get('known_faces')
         student_no_json = request.form.get('student_no')
         
-        if not known_faces_json or not student_no_json:
-            print("Missing known_faces or student_no")
+        if (known_faces_part is None and not known_faces_json) or not student_no_json:
+            log.warning("Missing known_faces or student_no")
             return jsonify({
                 "error": "Missing known_faces or student_no", 
                 "name": "unknown", 
@@ -56,7 +61,7 @@ def get_similarity():
         file_size = file.tell()
         file.seek(0)  # Reset file pointer
         
-        print(f"File size: {file_size} bytes")
+        log.debug("File size: %d bytes", file_size)
         
         if file_size > app.config.get('MAX_CONTENT_LENGTH', MAX_FILE_SIZE):
             return jsonify({
@@ -84,24 +89,33 @@ def get_similarity():
                 "confidence": 0.0
             }), 400
 
-        # Parse JSON data
-        print("known_faces raw:", known_faces_json)
-        print("student_no raw:", student_no_json)
+        # Parse known faces (binary .npy / compact file part, or JSON form field)
+        log.debug("student_no raw: %s", student_no_json)
 
         try:
-            known_faces_encoding = json.loads(known_faces_json)
+            if known_faces_part is not None:
+                known_faces_encoding = decode_body(known_faces_part.read(), known_faces_part.mimetype)
+            else:
+                known_faces_encoding = json.loads(known_faces_json)
             student_numbers = json.loads(student_no_json)
         except json.JSONDecodeError as e:
-            print(f"JSON decode error: {str(e)}")
+            log.warning("JSON decode error: %s", e)
             return jsonify({
                 "error": f"Invalid JSON format: {str(e)}", 
                 "name": "unknown", 
                 "confidence": 0.0
             }), 400
+        except EncodingFormatError as e:
+            log.warning("Encoding decode error: %s", e)
+            return jsonify({
+                "error": f"Invalid known_faces encoding: {str(e)}", 
+                "name": "unknown", 
+                "confidence": 0.0
+            }), 400
 
         # Validate data
-        if not known_faces_encoding or not student_numbers:
-            print("Missing known_faces or student_no after parsing")
+        if len(known_faces_encoding) == 0 or not student_numbers:
+            log.warning("Missing known_faces or student_no after parsing")
             return jsonify({
                 "error": "Missing known_faces or student_no", 
                 "name": "unknown", 
@@ -120,7 +134,7 @@ def get_similarity():
         })
 
     except Exception as e:
-        print(f"Error in get_similarity: {str(e)}")
+        log.error("Error in get_similarity: %s", e)
         return jsonify({
             "error": str(e), 
             "name": "unknown", 
@@ -140,12 +154,13 @@ def transcribe():
         if file.filename == '':
             return jsonify({"error": "No file selected"}), 400
 
-        # Get JSON data from form
+        # Get JSON data from form; known_faces may also come as a binary file part
+        known_faces_part = request.files.get('known_faces')
         known_faces_json = request.form.get('known_faces')
         student_no_json = request.form.get('student_no')
         
         # Convert image to NumPy array
-        print('Loading image...')
+        log.debug('Loading image...')
         try:
             content = file.read()
             image_array = np.frombuffer(content, np.uint8)
@@ -155,25 +170,31 @@ def transcribe():
                 return jsonify({"error": "Error while image processing"}), 400
                 
         except Exception as e:
-            print(f"Error while image processing: {str(e)}")
+            log.warning("Error while image processing: %s", e)
             return jsonify({"error": "Error while image processing"}), 400
 
         # Parse the arguments
-        print("Passing arguments")
+        log.debug("Passing arguments")
         try:
-            known_faces_encoding = json.loads(known_faces_json)  # List[List[float]]
+            if known_faces_part is not None:
+                known_faces_encoding = decode_body(known_faces_part.read(), known_faces_part.mimetype)
+            else:
+                known_faces_encoding = json.loads(known_faces_json)  # List[List[float]]
             known_faces_id = json.loads(student_no_json)         # List[int]
-            print('Known face encodings: ', known_faces_encoding)
-            print('Student numbers: ', known_faces_id)
+            log.debug('Known face encodings: %s', summarize(known_faces_encoding))
+            log.debug('Student numbers: %s', summarize(known_faces_id))
+        except EncodingFormatError as e:
+            log.warning("Encoding decode error: %s", e)
+            return jsonify({"error": f"Invalid known_faces encoding: {str(e)}"}), 400
         except Exception as e:
-            print(f"Error while parsing args: {str(e)}")
+            log.warning("Error while parsing args: %s", e)
             return jsonify({"error": "Error while parsing args"}), 400
 
-        print("Getting similarity")
+        log.debug("Getting similarity")
         try:
             name, confidence = mpfr._recognize_face_modified(image, known_faces_encoding, known_faces_id)
         except Exception as e:
-            print(f"Error while getting similarity: {str(e)}")
+            log.warning("Error while getting similarity: %s", e)
             return jsonify({"error": "Error while getting similarity"}), 400
 
         # Check error
@@ -181,9 +202,9 @@ def transcribe():
             return jsonify({"error": "No matches"}), 400
 
         # Print
-        print(f"Name: {name} = {confidence}")
+        log.info("Name: %s = %s", name, confidence)
         return jsonify({"name": name, "confidence": confidence})
 
     except Exception as e:
-        print(f"Error in transcribe: {str(e)}")
+        log.error("Error in transcribe: %s", e)
         return jsonify({"error": str(e)}), 500
\ No newline at end of file